@@ -0,0 +1,61 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+# Generates synthetic 7z archives for the benchmarks with the package's own writer, no 7z
+# binary required.
+
+import os
+import random
+
+from subsevenzip import create
+from subsevenzip.enums import CodecId
+
+WORDS = [word.encode() for word in (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+    "et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip "
+    "ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla").split()]
+
+DISTRIBUTIONS = ("tiny", "small", "mixed", "large")
+
+
+def member_size(rng, distribution):
+    if distribution == "tiny":
+        return rng.randint(0, 256)
+    if distribution == "small":
+        return rng.randint(1024, 16 * 1024)
+    if distribution == "large":
+        return rng.randint(1024 * 1024, 4 * 1024 * 1024)
+    # Mostly small files with the occasional large one, like a source tree with assets
+    return int(rng.lognormvariate(8, 2)) % (8 * 1024 * 1024)
+
+
+def member_content(rng, size):
+    # Text-like data compresses like real files, unlike random bytes or runs of zeros
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rng.choice(WORDS) for x in range(64)) + b"\n"
+    return bytes(out[:size])
+
+
+def generate(path, entries, distribution="small", files_per_folder=None, seed=0, jobs=None):
+    # files_per_folder=None puts everything in one solid folder
+    rng = random.Random(seed)
+    with create(path + ".tmp", codec=CodecId.LZMA, dict_size=1 << 20, folder_size=None,
+                files_per_folder=files_per_folder, jobs=jobs) as writer:
+        for index in range(entries):
+            content = member_content(rng, member_size(rng, distribution))
+            writer.add("dir%03d/file%07d.txt" % (index % 997, index), content)
+    os.replace(path + ".tmp", path)
+    return path
@@ -0,0 +1,206 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+# Runs the read benchmarks over a synthetic corpus and writes the results as JSON.
+#
+#   python benchmarks/run.py --entries 10,1000,100000 --layout solid,multi --output results.json
+#   python benchmarks/run.py --crc-mode off,verify --pattern sequential
+#   python benchmarks/run.py --baseline results.json
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import tracemalloc
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import subsevenzip                  # noqa
+from corpus import generate, DISTRIBUTIONS  # noqa
+
+PATTERNS = ("sequential", "random", "reverse")
+LAYOUTS = ("solid", "multi")
+CRC_MODES = tuple(mode.value for mode in subsevenzip.CrcMode)
+
+
+def csv(kind=str):
+    return lambda value: [kind(x) for x in value.split(",") if x]
+
+
+def corpus_path(directory, entries, distribution, files_per_folder, seed, jobs=None):
+    name = "%d-%s-%s-%d.7z" % (entries, distribution, files_per_folder or "solid", seed)
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        generate(path, entries, distribution, files_per_folder, seed, jobs)
+    return path
+
+
+def pick(files, pattern, reads, seed):
+    files = [file for file in files if file.has_stream]
+    if pattern == "random":
+        return random.Random(seed).sample(files, min(reads, len(files)))
+    if pattern == "reverse":
+        return files[::-1][:reads]
+    return files[:reads]
+
+
+def read_all(path, wanted, cache_size, crc_mode):
+    stats = subsevenzip.Stats()
+    total = 0
+    with subsevenzip.open(path, cache_size=cache_size, crc_mode=crc_mode, stats=stats) as sz:
+        for index in wanted:
+            total += len(sz.get_content(sz.files[index]))
+    return total, stats
+
+
+def run_case(path, pattern, crc_mode, args):
+    opens = []
+    for x in range(args.repeat):
+        stats = subsevenzip.Stats()
+        start = time.perf_counter()
+        with subsevenzip.open(path, stats=stats) as sz:
+            opens.append(time.perf_counter() - start)
+            files = sz.files[:]
+    indices = {id(file): index for index, file in enumerate(files)}
+    wanted = [indices[id(file)] for file in pick(files, pattern, args.reads, args.seed)]
+
+    start = time.perf_counter()
+    total, read_stats = read_all(path, wanted, args.cache_size, crc_mode)
+    elapsed = time.perf_counter() - start
+
+    # Allocation tracking slows everything down, so memory is measured in a separate pass
+    tracemalloc.start()
+    read_all(path, wanted, args.cache_size, crc_mode)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    counters = read_stats.snapshot()["counters"]
+    return {
+        "open_seconds": min(opens),
+        "open_seconds_all": opens,
+        "signature_seconds": stats.timings["signature"],
+        "header_decode_seconds": stats.timings["header_decode"],
+        "header_parse_seconds": stats.timings["header_parse"],
+        "members_read": len(wanted),
+        "bytes_returned": total,
+        "bytes_decoded": counters.get("bytes_decoded", 0),
+        "decoder_starts": counters.get("decoder_starts", 0),
+        "decoder_restarts": counters.get("decoder_restarts", 0),
+        "read_seconds": elapsed,
+        "throughput_mb_s": total / elapsed / 1e6 if elapsed else None,
+        "peak_traced_bytes": peak
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    # Results from before CRC modes were benchmarked ran without verification
+    return tuple(result[key] for key in ("entries", "distribution", "layout", "pattern")) + \
+        (result.get("crc_mode", "off"),)
+
+
+def compare(results, baseline):
+    with open(baseline) as fd:
+        previous = {case_key(result): result for result in json.load(fd)["results"]}
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        print("%-48s open %+6.1f%%  throughput %+6.1f%%" % (
+            "/".join(str(x) for x in case_key(result)),
+            100.0 * (result["open_seconds"] / old["open_seconds"] - 1),
+            100.0 * (result["throughput_mb_s"] / old["throughput_mb_s"] - 1)
+            if result["throughput_mb_s"] and old["throughput_mb_s"] else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark subsevenzip on synthetic archives")
+    parser.add_argument("--entries", type=csv(int), default=[10, 1000, 100000])
+    parser.add_argument("--distribution", type=csv(), default=["small"], help=",".join(DISTRIBUTIONS))
+    parser.add_argument("--layout", type=csv(), default=list(LAYOUTS), help=",".join(LAYOUTS))
+    parser.add_argument("--pattern", type=csv(), default=list(PATTERNS), help=",".join(PATTERNS))
+    parser.add_argument("--files-per-folder", type=int, default=64)
+    parser.add_argument("--reads", type=int, default=200, help="members read per case")
+    parser.add_argument("--repeat", type=int, default=3, help="open() repetitions per case")
+    parser.add_argument("--crc-mode", type=csv(), default=["off"], help=",".join(CRC_MODES))
+    parser.add_argument("--cache-size", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=None, help="processes compressing the corpus")
+    parser.add_argument("--corpus-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus"))
+    parser.add_argument("--output", default=None, help="JSON results file, defaults to stdout")
+    parser.add_argument("--baseline", default=None, help="earlier results to compare against")
+    args = parser.parse_args()
+
+    os.makedirs(args.corpus_dir, exist_ok=True)
+
+    results = []
+    for entries in args.entries:
+        for distribution in args.distribution:
+            for layout in args.layout:
+                files_per_folder = args.files_per_folder if layout == "multi" else None
+                path = corpus_path(args.corpus_dir, entries, distribution, files_per_folder, args.seed, args.jobs)
+                for pattern in args.pattern:
+                    for crc_mode in args.crc_mode:
+                        result = {
+                            "entries": entries,
+                            "distribution": distribution,
+                            "layout": layout,
+                            "pattern": pattern,
+                            "crc_mode": crc_mode,
+                            "archive_bytes": os.path.getsize(path)
+                        }
+                        result.update(run_case(path, pattern, crc_mode, args))
+                        results.append(result)
+                        print("%-48s open %8.2fms  read %8.1fMB/s" % (
+                            "/".join(str(x) for x in case_key(result)), result["open_seconds"] * 1000,
+                            result["throughput_mb_s"] or 0), file=sys.stderr)
+
+    document = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "arguments": vars(args)
+        },
+        "results": results
+    }
+
+    if args.output is None:
+        json.dump(document, sys.stdout, indent=2)
+    else:
+        with open(args.output, "w") as fd:
+            json.dump(document, fd, indent=2)
+
+    if args.baseline is not None:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,4 +13,7 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 from .archive import open                   # noqa
+from .writer import create                  # noqa
+from .enums import CrcMode                  # noqa
 from .exceptions import BadSevenZipArchive  # noqa
+from .stats import Stats                    # noqa
@@ -0,0 +1,112 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import asyncio
+from functools import partial
+
+from . import archive
+
+
+class AsyncMemberReader(object):
+    def __init__(self, reader, executor):
+        self._reader = reader
+        self._executor = executor
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args))
+
+    async def read(self, size=-1):
+        return await self._run(self._reader.read, size)
+
+    async def readinto(self, buffer):
+        return await self._run(self._reader.readinto, buffer)
+
+    def tell(self):
+        return self._reader.tell()
+
+    async def close(self):
+        self._reader.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read(1024 * 1024)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+
+class AsyncSevenZipArchive(object):
+    def __init__(self, archive, executor=None):
+        self._archive = archive
+        self._executor = executor
+
+    def _run(self, func, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    @property
+    def files(self):
+        return self._archive.files
+
+    @property
+    def crc_errors(self):
+        return self._archive.crc_errors
+
+    async def get_content(self, file, start=0, length=None):
+        return await self._run(self._archive.get_content, file, start, length)
+
+    async def get_contents(self, files, jobs=None):
+        return await self._run(self._archive.get_contents, list(files), jobs)
+
+    async def extractall(self, path, jobs=4):
+        return await self._run(self._archive.extractall, path, jobs)
+
+    def open_member(self, file):
+        return AsyncMemberReader(self._archive.open_member(file), self._executor)
+
+    async def iter_contents(self, chunk_size=1024 * 1024):
+        # Chunks are only decoded when the consumer asks for the next one, so nothing piles up
+        for file in self._archive.files:
+            reader = self._archive.open_member(file)
+            try:
+                chunk = await self._run(reader.read, chunk_size)
+                if not chunk:
+                    yield file, b""
+                while chunk:
+                    yield file, chunk
+                    chunk = await self._run(reader.read, chunk_size)
+            finally:
+                reader.close()
+
+    async def close(self):
+        self._archive.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def open(arg, executor=None, **kwargs):
+    loop = asyncio.get_event_loop()
+    return AsyncSevenZipArchive(await loop.run_in_executor(executor, partial(archive.open, arg, **kwargs)), executor)
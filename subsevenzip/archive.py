@@ -12,52 +12,513 @@
 # OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
-import lzma
 import io
+import os
+import mmap
+import zlib
 import builtins
+import threading
+from functools import partial
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from .enums import CrcMode
+from .exceptions import BadSevenZipArchive
 from .parser import parse_headers
-from .buffer import ReadBuffer
-from .codec import open_lzma_stream
+from .buffer import ReadBuffer, MemoryReadBuffer
+from .codec import open_stream
+from .cache import DecodedCache, SpillFile
+from .extract import TargetFile, target_path
+from .index import SIGNATURE_HEADER_SIZE, index_key, read_index, write_index
+from .stats import TracedStream, timer
+from .volume import VolumeStream, volume_paths
 
 
-class SevenZipArchive(object):
-    def __init__(self, factory, files):
+class BatchResult(list):
+    def __init__(self, contents, bytes_decoded, bytes_discarded):
+        list.__init__(self, contents)
+        self.bytes_decoded = bytes_decoded
+        self.bytes_discarded = bytes_discarded
+
+
+class Folder(object):
+    def __init__(self, factory, size, spill=None, checksum=None, pool_size=4, stats=None):
         self._factory = factory
+        self.stats = stats
+        self._idle = []
+        self._lock = threading.Lock()
+        self.size = size
+        self.spill = spill
+        self.checksum = checksum
+        self.pool_size = pool_size
+        self.verify = None
+
+    def open(self):
+        return self._factory()
+
+    def acquire(self, offset):
+        # Hands out the idle decoder closest before the offset, LZMA streams can't seek backward
+        # so anything else means restarting decoding from the beginning
+        with self._lock:
+            best = None
+            for stream in self._idle:
+                position = stream.tell()
+                if position <= offset and (best is None or position > best.tell()):
+                    best = stream
+            if best is not None:
+                self._idle.remove(best)
+                return best
+            if self._idle and self.stats is not None:
+                # Every idle decoder is already past the offset
+                self.stats.count("decoder_restarts")
+        return self._factory()
+
+    def release(self, stream):
+        with self._lock:
+            self._idle.append(stream)
+            if len(self._idle) <= self.pool_size:
+                return
+            evicted = min(self._idle, key=lambda x: x.tell())
+            self._idle.remove(evicted)
+        evicted.close()
+
+    @contextmanager
+    def decoder(self, offset):
+        # A decoder that raised is in an unknown state, only a clean one goes back to the pool
+        stream = self.acquire(offset)
+        try:
+            yield stream
+        except BaseException:
+            stream.close()
+            raise
+        self.release(stream)
+
+    def fill_spill(self):
+        with self._lock:
+            if self.spill.is_filled():
+                return
+            with self._factory() as stream:
+                crc = self.spill.fill(stream, self.size, self.verify is not None)
+        if self.verify is not None:
+            self.verify(crc)
+
+    def read(self, offset, size):
+        if self.spill is not None:
+            if not self.spill.is_filled():
+                self.fill_spill()
+            return self.spill.get(offset, size)
+        with self.decoder(offset) as stream:
+            stream.seek(offset)
+            # Stored folders read as views of the archive, content is handed out as bytes so it doesn't pin it
+            return bytes(stream.read(size))
+
+    def read_many(self, wanted):
+        contents = {}
+        decoded = 0
+        discarded = 0
+        with self.decoder(wanted[0][0]) as stream:
+            position = stream.tell()
+            for offset, size in wanted:
+                # Skipped bytes are decoded in chunks and dropped by the seek
+                discarded += offset - position
+                stream.seek(offset)
+                contents[offset, size] = bytes(stream.read(size))
+                decoded += offset - position + size
+                position = offset + size
+        return contents, decoded, discarded
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for stream in idle:
+            stream.close()
+        if self.spill is not None:
+            self.spill.close()
+
+
+class MemberReader(io.RawIOBase):
+    def __init__(self, folder, offset, size, verify=None):
+        self._folder = folder
+        self._offset = offset
+        self._size = size
+        self._verify = verify
+        self._crc = 0
         self._stream = None
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _discard(self):
+        # Decoders that raised or came up short are closed rather than handed back to the pool
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.close()
+
+    def _read_decoded(self, size, view=None):
+        # Decodes size bytes, into view when given
+        try:
+            if self._stream is None:
+                self._stream = self._folder.acquire(self._offset + self._pos)
+                self._stream.seek(self._offset + self._pos)
+            if view is None:
+                data = bytes(self._stream.read(size))
+                length = len(data)
+            else:
+                data = view
+                length = 0
+                while length < size:
+                    count = self._stream.readinto(view[length:])
+                    if not count:
+                        break
+                    length += count
+        except BaseException:
+            self._discard()
+            raise
+        if length < size:
+            self._discard()
+            raise BadSevenZipArchive("Member truncated at %d of %d bytes" % (self._pos + length, self._size))
+        self._pos += size
+        if self._folder.stats is not None:
+            self._folder.stats.count("bytes_returned", size)
+        if self._verify is not None:
+            self._crc = zlib.crc32(data, self._crc)
+            if self._pos == self._size:
+                self._verify(self._crc)
+        return data
+
+    def _remaining(self, size):
+        remaining = self._size - self._pos
+        if size is None or size < 0 or size > remaining:
+            return remaining
+        return size
+
+    def read(self, size=-1):
+        size = self._remaining(size)
+        if size <= 0:
+            return b""
+        return self._read_decoded(size)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        size = self._remaining(len(view))
+        if size <= 0:
+            return 0
+        self._read_decoded(size, view[:size])
+        return size
+
+    def __next__(self):
+        # Members are iterated in fixed size chunks, like the async reader, rather than by line
+        chunk = self.read(1024 * 1024)
+        if not chunk:
+            raise StopIteration
+        return chunk
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._stream is not None:
+            self._folder.release(self._stream)
+            self._stream = None
+        super().close()
+
+
+class SevenZipArchive(object):
+    def __init__(self, folders, files, cache=None, fd=None, executor=None, crc_mode=CrcMode.OFF, stats=None,
+                 buf=None):
+        self._folders = folders
+        self._buf = buf
+        self.stats = stats
+        self._fd = fd
+        self._executor = executor
         self.files = files
+        self.cache = cache
+        self.crc_mode = CrcMode(crc_mode)
+        self.crc_errors = []
+        if self.crc_mode != CrcMode.OFF:
+            for index, folder in enumerate(folders):
+                if folder.checksum is not None:
+                    folder.verify = partial(self._verify, "folder %d" % index, folder.checksum)
+
+    def _verify(self, name, expected, actual):
+        if expected == actual:
+            return
+        error = BadSevenZipArchive("CRC mismatch for %s, expected %08x, got %08x" % (name, expected, actual))
+        if self.crc_mode == CrcMode.VERIFY_AND_RAISE:
+            raise error
+        self.crc_errors.append(error)
+
+    def _check_content(self, file, content):
+        if self.crc_mode != CrcMode.OFF and file.crc is not None:
+            self._verify(file.name, file.crc, zlib.crc32(content))
+        return content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for folder in self._folders:
+            folder.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self.cache is not None:
+            self.cache.clear()
+        if self._buf is not None:
+            # The view of the mapping is released before the mapping, which can't close while exported
+            self._buf.release()
+            self._buf = None
+        if self._fd is not None:
+            try:
+                self._fd.close()
+            except BufferError:
+                # Members the caller still has open keep the mapping alive until collected
+                pass
+            self._fd = None
+
+    def _read_cached(self, folder_index, offset, size):
+        folder = self._folders[folder_index]
+        window_size = self.cache.window_size
+        first = offset // window_size
+        last = (offset + size - 1) // window_size
+        windows = [self.cache.get((folder_index, index)) for index in range(first, last + 1)]
+        if None in windows:
+            missing = windows.index(None)
+            with folder.decoder((first + missing) * window_size) as stream:
+                stream.seek((first + missing) * window_size)
+                for index in range(missing, len(windows)):
+                    window = bytes(stream.read(min(window_size, folder.size - (first + index) * window_size)))
+                    if windows[index] is None:
+                        self.cache.put((folder_index, first + index), window)
+                    windows[index] = window
+        start = offset - first * window_size
+        return b"".join(windows)[start:start + size]
+
+    def get_content(self, file, start=0, length=None):
+        if start < 0 or (length is not None and length < 0):
+            raise ValueError("Negative range start:%d length:%s" % (start, length))
+        end = file.size if length is None else min(file.size, start + length)
+        if not file.has_stream or end <= start:
+            return b""
+        folder = self._folders[file._folder]
+        with timer(self.stats, "member_decode"):
+            # Decoding stops at the end of the range, the decoder is left there for the next read
+            if self.cache is None or folder.spill is not None or end - start > self.cache.budget:
+                content = folder.read(file._offset + start, end - start)
+            else:
+                content = self._read_cached(file._folder, file._offset + start, end - start)
+        if self.stats is not None:
+            self.stats.count("bytes_returned", len(content))
+        if start == 0 and end == file.size:
+            return self._check_content(file, content)
+        return content
+
+    def extractall(self, path, jobs=4, chunk_size=1024 * 1024):
+        targets = [(file, target_path(path, file.name)) for file in self.files]
+        for file, target in targets:
+            os.makedirs(target if file.is_dir else os.path.dirname(target), exist_ok=True)
+
+        stream = None
+        stream_folder = None
+        pending = deque()
+        # Decoding happens on this thread while the pool writes, in-flight chunks are bounded
+        with ThreadPoolExecutor(jobs) as executor:
+            try:
+                for file, target in targets:
+                    if file.is_dir:
+                        continue
+                    out = TargetFile(target, file.size if file.has_stream else 0)
+                    try:
+                        if not file.has_stream or file.size == 0:
+                            continue
+                        if stream_folder != file._folder:
+                            if stream is not None:
+                                stream.close()
+                            stream = self._folders[file._folder].open()
+                            stream_folder = file._folder
+                        stream.seek(file._offset)
+                        verify = self.crc_mode != CrcMode.OFF and file.crc is not None
+                        crc = 0
+                        for position in range(0, file.size, chunk_size):
+                            chunk = stream.read(min(chunk_size, file.size - position))
+                            if len(chunk) != min(chunk_size, file.size - position):
+                                raise BadSevenZipArchive("Member %s truncated at %d of %d bytes" % (
+                                    file.name, position + len(chunk), file.size))
+                            if verify:
+                                crc = zlib.crc32(chunk, crc)
+                            if self.stats is not None:
+                                self.stats.count("bytes_returned", len(chunk))
+                            pending.append(out.submit(executor, chunk, position))
+                            while len(pending) > jobs * 4:
+                                pending.popleft().result()
+                        if verify:
+                            self._verify(file.name, file.crc, crc)
+                    finally:
+                        out.done()
+                while pending:
+                    pending.popleft().result()
+            finally:
+                if stream is not None:
+                    stream.close()
+
+    def open_member(self, file):
+        if not file.has_stream:
+            # Empty entries have no folder, archives holding only those have no folders at all
+            return MemberReader(None, 0, 0)
+        verify = None
+        if self.crc_mode != CrcMode.OFF and file.crc is not None:
+            verify = partial(self._verify, file.name, file.crc)
+        return MemberReader(self._folders[file._folder], file._offset, file.size, verify)
+
+    def get_contents(self, files, jobs=None):
+        files = list(files)
+        plan = {}
+        for file in files:
+            if file.has_stream:
+                plan.setdefault(file._folder, set()).add((file._offset, file.size))
 
-    def get_content(self, file):
-        if not self._stream:
-            self._stream = self._factory()
+        def forward_pass(folder_index):
+            return folder_index, self._folders[folder_index].read_many(sorted(plan[folder_index]))
+
+        with timer(self.stats, "member_decode"):
+            if jobs is not None and jobs > 1 and len(plan) > 1:
+                # Folders are independent, and lzma releases the GIL while decoding
+                with ThreadPoolExecutor(jobs) as executor:
+                    passes = list(executor.map(forward_pass, plan))
+            else:
+                passes = [forward_pass(folder_index) for folder_index in plan]
+
+        contents = {}
+        decoded = 0
+        discarded = 0
+        checked = set()
+        for folder_index, (folder_contents, folder_decoded, folder_discarded) in passes:
+            for (offset, size), content in folder_contents.items():
+                contents[folder_index, offset, size] = content
+            decoded += folder_decoded
+            discarded += folder_discarded
+            if self.stats is not None:
+                self.stats.count("bytes_returned", sum(size for offset, size in folder_contents))
+
+        result = []
+        for file in files:
+            if not file.has_stream:
+                result.append(b"")
+                continue
+            key = file._folder, file._offset, file.size
+            if key not in checked:
+                self._check_content(file, contents[key])
+                checked.add(key)
+            result.append(contents[key])
+        return BatchResult(result, decoded, discarded)
+
+    def iter_contents(self):
+        streams = {}
         try:
-            self._stream.seek(file._offset)
-            return self._stream.read(file.size)
-        except lzma.LZMAError:
-            # Seems like it's not possible to seek backward
-            self._stream = self._factory()
-            self._stream.seek(file._offset)
-            return self._stream.read(file.size)
-
-
-def open(arg):
-    if isinstance(arg, bytes):
-        close_fd = -1
-        buf = ReadBuffer(io.BytesIO(arg))
+            for file in self.files:
+                if not file.has_stream:
+                    yield file, b""
+                    continue
+                if file._folder not in streams:
+                    streams[file._folder] = self._folders[file._folder].open()
+                stream = streams[file._folder]
+                stream.seek(file._offset)
+                content = bytes(stream.read(file.size))
+                if self.stats is not None:
+                    self.stats.count("bytes_returned", len(content))
+                yield file, self._check_content(file, content)
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+
+def open(arg, cache_size=None, spill_limit=None, jobs=None, index_dir=None, crc_mode=CrcMode.OFF, stats=None,
+         lazy=False, segment_limit=None, cache_window=None):
+    stat = None
+    if isinstance(arg, str):
+        paths = volume_paths(arg)
+        if len(paths) > 1:
+            arg = paths
+
+    if isinstance(arg, (list, tuple)):
+        # Split volumes are read through one virtual stream, pack streams may cross volume boundaries
+        close_fd = VolumeStream(arg)
+        buf = ReadBuffer(close_fd, stats)
+    elif isinstance(arg, bytes):
+        close_fd = None
+        buf = MemoryReadBuffer(arg)
     elif isinstance(arg, str):
-        close_fd = builtins.open(arg, "rb")
-        buf = ReadBuffer(close_fd)
+        with builtins.open(arg, "rb") as fd:
+            stat = os.fstat(fd.fileno())
+            if stat.st_size == 0:
+                raise BadSevenZipArchive("Empty file")
+            # The mapping keeps its own handle to the file
+            close_fd = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = MemoryReadBuffer(close_fd)
     elif hasattr(arg, "read") or hasattr(arg, "write"):
-        close_fd = -1
-        buf = ReadBuffer(arg)
+        close_fd = None
+        buf = ReadBuffer(arg, stats)
     else:
-        raise ValueError("Can only open a SevenZip archive from filename, bytes, or a file descriptor")
+        raise ValueError("Can only open a SevenZip archive from filename, list of volumes, bytes, or a file descriptor")
+
+    try:
+        archive = None
+        if index_dir is not None and stat is not None:
+            key = index_key(buf.get_bytes(SIGNATURE_HEADER_SIZE), stat)
+            buf.seek(0, io.SEEK_SET)
+            with timer(stats, "index_load"):
+                archive = read_index(index_dir, key)
+
+        if archive is None:
+            archive = parse_headers(buf, stats, lazy)
+            if index_dir is not None and stat is not None:
+                try:
+                    write_index(index_dir, key, archive)
+                except OSError:
+                    # The index is only a cache, failing to store it shouldn't fail the open
+                    pass
+    except BaseException:
+        # Nothing owns the mapping or the volume handles yet
+        if isinstance(buf, MemoryReadBuffer):
+            buf.release()
+        if close_fd is not None:
+            try:
+                close_fd.close()
+            except BufferError:
+                pass
+        raise
+
+    def folder_factory(folder):
+        def stream_factory():
+            offset = archive["payload_offset"] + folder["compressed_offset"]
+            stream = buf.get_sub_stream(folder["compressed_size"], offset)
+            stream = open_stream(stream, folder["coders"], executor, jobs, segment_limit)
+            return stream if stats is None else TracedStream(stream, stats)
+        return stream_factory
+
+    # Decodes independent LZMA2 segments of a folder concurrently
+    executor = ThreadPoolExecutor(jobs) if jobs is not None and jobs > 1 else None
+
+    decompressed_size = sum(folder["decompressed_size"] for folder in archive["folders"])
+    spill = spill_limit is not None and decompressed_size <= spill_limit
 
-    archive = parse_headers(buf)
+    folders = list()
+    for folder in archive["folders"]:
+        folders.append(Folder(folder_factory(folder), folder["decompressed_size"],
+                              SpillFile(spill_limit) if spill else None, folder.get("checksum"), stats=stats))
 
-    def stream_factory():
-        buf.seek(archive["payload_offset"], io.SEEK_SET)
-        stream = buf.get_sub_stream(archive["compressed_size"])
-        return open_lzma_stream(stream, archive["codec_properties"])
+    cache = None
+    if cache_size:
+        # Small budgets get windows that fit, rather than a cache that can never hold anything
+        cache = DecodedCache(cache_size, min(cache_size, 64 * 1024) if cache_window is None else cache_window)
 
-    return SevenZipArchive(stream_factory, archive["files"])
+    return SevenZipArchive(folders, archive["files"], cache, close_fd, executor, crc_mode, stats,
+                           buf if isinstance(buf, MemoryReadBuffer) else None)
@@ -0,0 +1,93 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+class BitVector(object):
+    __slots__ = ("_data", "_count", "_ranks")
+
+    # Bits are stored most significant bit first, the same layout 7-Zip uses on disk
+    def __init__(self, data, count):
+        if len(data) * 8 < count:
+            raise ValueError("%d bytes can't hold %d bits" % (len(data), count))
+        self._data = data
+        self._count = count
+        self._ranks = None
+
+    @classmethod
+    def zeros(cls, count):
+        return cls(bytes((count + 7) // 8), count)
+
+    @classmethod
+    def ones(cls, count):
+        data = bytearray(b"\xff" * ((count + 7) // 8))
+        if count & 7:
+            data[-1] = (0xff00 >> (count & 7)) & 0xff
+        return cls(bytes(data), count)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("BitVector index out of range")
+        return (self._data[index >> 3] & (0x80 >> (index & 7))) != 0
+
+    def __iter__(self):
+        data = self._data
+        for index in range(self._count):
+            yield (data[index >> 3] & (0x80 >> (index & 7))) != 0
+
+    def __eq__(self, other):
+        return isinstance(other, BitVector) and list(self) == list(other)
+
+    def __repr__(self):
+        return "BitVector('%s')" % "".join("1" if bit else "0" for bit in self)
+
+    def iter_set(self):
+        count = self._count
+        for byte_index, byte in enumerate(self._data):
+            if not byte:
+                continue
+            base = byte_index << 3
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    if base + bit >= count:
+                        return
+                    yield base + bit
+
+    def _popcount(self, start, index):
+        # Number of set bits from byte start up to bit index
+        whole = bin(int.from_bytes(self._data[start:index >> 3], "big")).count("1")
+        if index & 7:
+            whole += bin(self._data[index >> 3] & (0xff00 >> (index & 7)) & 0xff).count("1")
+        return whole
+
+    def count(self):
+        return self._popcount(0, self._count)
+
+    def rank(self, index):
+        # Number of set bits before index, from a table of counts before each 64 byte block that is
+        # built on first use so ranking every entry stays linear
+        if self._ranks is None:
+            ranks = [0]
+            for start in range(0, len(self._data), 64):
+                ranks.append(ranks[-1] + self._popcount(start, (start + 64) << 3))
+            self._ranks = ranks
+        block = index >> 9
+        return self._ranks[block] + self._popcount(block << 6, index)
+
+    def tobytes(self):
+        return bytes(self._data[:(self._count + 7) // 8])
@@ -13,33 +13,144 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 import io
+import os
 import struct
+import threading
+from functools import partial
 
+from .bitvector import BitVector
 
-class BoundedBufferedReader(io.BufferedReader):
-    def __init__(self, stream, limit):
-        io.BufferedReader.__init__(self, stream)
-        self._limit = limit
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
 
-    def read(self, size):
-        position = super().tell()
-        if (position + size) > self._limit:
-            return super().read(self._limit - position)
-        return super().read(size)
+# Extra bytes following the first byte of a 7z varint, which is the number of leading one bits
+VARINT_EXTRA = bytes(8 - (first ^ 0xff).bit_length() for first in range(256))
+
+
+class ReadStream(io.RawIOBase):
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class PositionalStream(ReadStream):
+    # A stream of self._size bytes that reads from self._pos, so seeking only moves the position
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class ForwardStream(ReadStream):
+    # A decoded stream that seeks by decoding and dropping the bytes up to the offset
+    def _skip(self, count):
+        raise NotImplementedError
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek from start or current position")
+        if offset < self._pos:
+            raise io.UnsupportedOperation("Can't seek backward in a %s" % self.kind)
+        if offset > self._pos:
+            self._skip(offset - self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class SubStream(PositionalStream):
+    def __init__(self, fd, lock, offset, length, pread=None, stats=None):
+        self._fd = fd
+        self._stats = stats
+        self._lock = lock
+        self._pread = pread
+        self._offset = offset
+        self._size = length
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._size - self._pos:
+            size = max(self._size - self._pos, 0)
+        if size == 0:
+            return b""
+        if self._pread is not None:
+            data = self._pread(size, self._offset + self._pos)
+        else:
+            # The parent file object is shared between sub streams, so seek + read must be atomic
+            with self._lock:
+                self._fd.seek(self._offset + self._pos)
+                data = self._fd.read(size)
+        self._pos += len(data)
+        if self._stats is not None:
+            self._stats.count("io_reads")
+            self._stats.count("io_bytes", len(data))
+        return data
+
+
+class MemoryStream(PositionalStream):
+    def __init__(self, view):
+        self._view = view
+        self._size = len(view)
+        self._pos = 0
+
+    def read(self, size=-1):
+        start = min(self._pos, self._size)
+        if size is None or size < 0:
+            end = self._size
+        else:
+            end = min(start + size, self._size)
+        self._pos = end
+        # Hands out slices of the underlying buffer, decompressors accept any bytes-like object
+        return self._view[start:end]
 
     def close(self):
-        # Should not close parent file descriptor
-        pass
+        self._view.release()
+        super().close()
+
+
+def is_os_file(fd):
+    # Wrappers such as GzipFile expose the fileno of the stream they decode, reading that directly
+    # would return the compressed bytes
+    if isinstance(fd, (io.BufferedReader, io.BufferedRandom)):
+        fd = fd.raw
+    return isinstance(fd, io.FileIO)
 
 
 class ReadBuffer(object):
-    def __init__(self, fd):
+    def __init__(self, fd, stats=None):
         assert isinstance(fd, io.IOBase)
         self._fd = fd
+        self._stats = stats
+        self._lock = threading.Lock()
+        # Positional reads don't move the shared file position, so sub streams can skip the lock
+        self._pread = getattr(fd, "pread", None)
         self._pos = 0
         self._limit = None
+        if self._pread is None and hasattr(os, "pread") and is_os_file(fd):
+            self._pread = partial(os.pread, fd.fileno())
 
     def _read(self, func):
+        if self._stats is not None:
+            self._stats.count("io_reads")
         try:
             return func()
         finally:
@@ -84,34 +195,18 @@ class ReadBuffer(object):
         return value
 
     def get_bits(self, count):
-        value = 0
-        mask = 0
-        cache = 0
-        for x in range(count):
-            if not mask:
-                mask = 0x80
-                cache = self.get_uint8()
-            value |= int((cache & mask) != 0) << x
-            mask >>= 1
-        return value
+        size = (count + 7) // 8
+        data = self.get_bytes(size)
+        if len(data) != size:
+            raise IOError("Expected %d bytes of bits, got %d" % (size, len(data)))
+        return BitVector(data, count)
 
     def get_all_or_bits(self, count):
         all_defined = self.get_uint8()
         if all_defined:
-            return (1 << count) - 1
+            return BitVector.ones(count)
         return self.get_bits(count)
 
-    def get_utf16_le(self):
-        buffer = bytearray([])
-        while True:
-            value1 = self.get_uint8()
-            value2 = self.get_uint8()
-            if value1 == 0 and value2 == 0:
-                return buffer.decode("utf-16-le")
-            buffer.append(value1)
-            buffer.append(value2)
-        raise IOError("UTF-16 string was not \\0 terminated")
-
     def get_bytes(self, length):
         return self._read(lambda: self._fd.read(length))
 
@@ -122,5 +217,117 @@ class ReadBuffer(object):
     def tell(self):
         return self._fd.tell()
 
-    def get_sub_stream(self, length):
-        return BoundedBufferedReader(self._fd, self._fd.tell() + length)
+    def get_sub_stream(self, length, offset=None):
+        if offset is None:
+            offset = self._fd.tell()
+        return SubStream(self._fd, self._lock, offset, length, self._pread, self._stats)
+
+
+class MemoryReadBuffer(object):
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._size = len(self._view)
+        self._pos = 0
+        self._limit = None
+        self._bound = self._size
+
+    def _overflow(self, position):
+        if self._limit is not None and position > self._limit:
+            return IOError("Overflow, position:%d > limit:%d" % (position, self._limit))
+        return IOError("Overflow, position:%d > size:%d" % (position, self._size))
+
+    def _advance(self, size):
+        position = self._pos
+        if position + size > self._bound:
+            raise self._overflow(position + size)
+        self._pos = position + size
+        return position
+
+    def set_limit(self, limit, absolute=False):
+        self._limit = limit if absolute else self._pos + limit
+        self._bound = min(self._limit, self._size)
+
+    def unset_limit(self):
+        self._limit = None
+        self._bound = self._size
+
+    def get_uint8(self):
+        position = self._pos
+        if position >= self._bound:
+            raise self._overflow(position + 1)
+        self._pos = position + 1
+        return self._view[position]
+
+    def get_uint16(self):
+        return UINT16.unpack_from(self._view, self._advance(2))[0]
+
+    def get_uint32(self):
+        return UINT32.unpack_from(self._view, self._advance(4))[0]
+
+    def get_uint64(self):
+        return UINT64.unpack_from(self._view, self._advance(8))[0]
+
+    def get_varint(self):
+        first_byte = self.get_uint8()
+        if first_byte < 0x80:
+            return first_byte
+        mask = 0x80
+        value = 0
+        for x in range(8):
+            if (first_byte & mask) == 0:
+                return value | ((first_byte & (mask - 1)) << 8 * x)
+            value |= self.get_uint8() << 8 * x
+            mask >>= 1
+        return value
+
+    def skip_varints(self, count):
+        view = self._view
+        extra = VARINT_EXTRA
+        position = self._pos
+        for x in range(count):
+            position += 1 + extra[view[position]]
+        if position > self._bound:
+            raise self._overflow(position)
+        self._pos = position
+
+    def get_bits(self, count):
+        position = self._advance((count + 7) // 8)
+        return BitVector(self._view[position:self._pos].tobytes(), count)
+
+    def get_all_or_bits(self, count):
+        all_defined = self.get_uint8()
+        if all_defined:
+            return BitVector.ones(count)
+        return self.get_bits(count)
+
+    def get_bytes(self, length):
+        length = min(length, self._size - self._pos)
+        position = self._advance(length)
+        return self._view[position:self._pos].tobytes()
+
+    def get_sub_stream(self, length, offset=None):
+        if offset is None:
+            offset = self._pos
+        return MemoryStream(self._view[offset:offset + length])
+
+    def seek(self, offset, whence=io.SEEK_CUR):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            self._pos += offset
+        if self._limit is not None and self._pos > self._limit:
+            raise self._overflow(self._pos)
+
+    def tell(self):
+        return self._pos
+
+    def fork(self, position):
+        # An independent cursor over the same data
+        buf = MemoryReadBuffer(self._view)
+        buf.seek(position, io.SEEK_SET)
+        return buf
+
+    def release(self):
+        self._view.release()
@@ -12,19 +12,177 @@
 # OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
+from array import array
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+
+from .bitvector import BitVector
+
+
+def directory_mask(count, empty_stream_mask, empty_file_mask=None):
+    # Entries without a stream are directories, unless flagged as empty files
+    mask = bytearray((count + 7) // 8)
+    for position, index in enumerate(empty_stream_mask.iter_set()):
+        if empty_file_mask is None or not empty_file_mask[position]:
+            mask[index >> 3] |= 0x80 >> (index & 7)
+    return BitVector(bytes(mask), count)
+
 
 class File(object):
+    __slots__ = ("name", "size", "crc", "is_dir", "_offset", "_folder", "has_stream")
 
-    def __init__(self, name, size, offset, has_stream):
+    def __init__(self, name, size, offset, has_stream, folder=0, crc=None, is_dir=False):
         self.name = name
         self.size = size
+        self.crc = crc
+        self.is_dir = is_dir
         self._offset = offset
+        self._folder = folder
         self.has_stream = has_stream
 
     def __repr__(self):
         return "File('%s', size:%d, stream:%s)" % (self.name, self.size, self.has_stream)
 
 
+class FileTable(object):
+    def __init__(self, names, sizes, offsets, folders, empty_stream_mask, checksums, checksum_mask, directory_mask):
+        self.names = names
+        self.sizes = sizes
+        self.offsets = offsets
+        self.folders = folders
+        self.empty_stream_mask = empty_stream_mask
+        self.checksums = checksums
+        self.checksum_mask = checksum_mask
+        self.directory_mask = directory_mask
+        self._index = None
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _file(self, index):
+        return File(self.names[index], self.sizes[index], self.offsets[index],
+                    not self.empty_stream_mask[index], self.folders[index],
+                    self.checksums[index] if self.checksum_mask[index] else None,
+                    self.directory_mask[index])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._file(x) for x in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("FileTable index out of range")
+        return self._file(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._file(index)
+
+    def __repr__(self):
+        return "FileTable(%d files)" % len(self)
+
+    def index_of(self, name):
+        if self._index is None:
+            index = {}
+            # Keep the first entry when names are duplicated
+            for position in range(len(self.names) - 1, -1, -1):
+                index[self.names[position]] = position
+            self._index = index
+        return self._index[name]
+
+    def get(self, name, default=None):
+        try:
+            return self._file(self.index_of(name))
+        except KeyError:
+            return default
+
+    def find_prefix(self, prefix):
+        if self._sorted is None:
+            self._sorted = sorted((name or "", index) for index, name in enumerate(self.names))
+        result = []
+        for position in range(bisect_left(self._sorted, (prefix,)), len(self._sorted)):
+            name, index = self._sorted[position]
+            if not name.startswith(prefix):
+                break
+            result.append(index)
+        return [self._file(index) for index in sorted(result)]
+
+    def glob(self, pattern):
+        prefix = pattern
+        for wildcard in "*?[":
+            prefix = prefix.split(wildcard, 1)[0]
+        return [file for file in self.find_prefix(prefix) if fnmatchcase(file.name, pattern)]
+
+
+class LazyFileTable(FileTable):
+    # Columns are materialised from the header on first access. Until then single files are
+    # located through the source without decoding the entries before them.
+    def __init__(self, count, source):
+        self._count = count
+        self._source = source
+        self._names = None
+        self._columns = None
+        self._empty_stream_mask = None
+        self._directory_mask = None
+        self._index = None
+        self._sorted = None
+        self._scanned = False
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self._source.names()
+        return self._names
+
+    @property
+    def empty_stream_mask(self):
+        if self._empty_stream_mask is None:
+            self._empty_stream_mask = self._source.empty_stream_mask()
+        return self._empty_stream_mask
+
+    @property
+    def directory_mask(self):
+        if self._directory_mask is None:
+            self._directory_mask = self._source.directory_mask()
+        return self._directory_mask
+
+    def _materialise(self):
+        if self._columns is None:
+            self._columns = self._source.columns()
+        return self._columns
+
+    sizes = property(lambda self: self._materialise()[0])
+    offsets = property(lambda self: self._materialise()[1])
+    folders = property(lambda self: self._materialise()[2])
+    checksums = property(lambda self: self._materialise()[3])
+    checksum_mask = property(lambda self: self._materialise()[4])
+
+    def index_of(self, name):
+        # The first lookup scans the names, building the index only pays off for repeated lookups
+        if self._index is None and not self._scanned:
+            self._scanned = True
+            try:
+                return self.names.index(name)
+            except ValueError:
+                raise KeyError(name)
+        return FileTable.index_of(self, name)
+
+    def _file(self, index):
+        if self._columns is not None:
+            return FileTable._file(self, index)
+        if self.empty_stream_mask[index]:
+            return File(self.names[index], 0, 0, False, 0, None, self.directory_mask[index])
+        size, offset, folder, crc = self._source.locate(index - self.empty_stream_mask.rank(index))
+        return File(self.names[index], size, offset, True, folder, crc, False)
+
+    def __repr__(self):
+        return "LazyFileTable(%d files)" % len(self)
+
+
 class FilesInfoBuilder(object):
     def __init__(self):
         self.reset(0)
@@ -32,9 +190,13 @@ class FilesInfoBuilder(object):
     def reset(self, size):
         self.count = size
         self.names = [None] * size
-        self.sizes = [0] * size
-        self.offsets = [0] * size
-        self.empty_stream_mask = 0
+        self.sizes = array("Q", [0]) * size
+        self.offsets = array("Q", [0]) * size
+        self.folders = array("I", [0]) * size
+        self.empty_stream_mask = BitVector.zeros(size)
+        self.checksums = array("I", [0]) * size
+        self.checksum_mask = bytearray((size + 7) // 8)
+        self.empty_file_mask = None
 
     def set_name(self, index, name):
         self.names[index] = name
@@ -45,17 +207,25 @@ class FilesInfoBuilder(object):
     def set_offset(self, index, offset):
         self.offsets[index] = offset
 
+    def set_folder(self, index, folder):
+        self.folders[index] = folder
+
+    def set_checksum(self, index, checksum):
+        self.checksums[index] = checksum
+        self.checksum_mask[index >> 3] |= 0x80 >> (index & 7)
+
     def set_empty_stream_mask(self, mask):
         self.empty_stream_mask = mask
 
+    def set_empty_file_mask(self, mask):
+        self.empty_file_mask = mask
+
+    def _directory_mask(self):
+        return directory_mask(self.count, self.empty_stream_mask, self.empty_file_mask)
+
     def build(self):
-        result = [None] * self.count
-        for idx in range(self.count):
-            result[idx] = File(
-                self.names[idx],
-                self.sizes[idx],
-                self.offsets[idx],
-                ((1 << idx) & self.empty_stream_mask) == 0
-            )
+        result = FileTable(self.names, self.sizes, self.offsets, self.folders, self.empty_stream_mask,
+                           self.checksums, BitVector(bytes(self.checksum_mask), self.count),
+                           self._directory_mask())
         self.reset(0)
         return result
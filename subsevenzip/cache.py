@@ -0,0 +1,116 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import mmap
+import zlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class DecodedCache(object):
+    def __init__(self, budget, window_size=64 * 1024):
+        if budget < window_size:
+            raise ValueError("Cache budget %d is smaller than a window of %d bytes" % (budget, window_size))
+        self.budget = budget
+        self.window_size = window_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, index):
+        with self._lock:
+            window = self._windows.get(index)
+            if window is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._windows.move_to_end(index)
+            return window
+
+    def put(self, index, window):
+        if len(window) > self.budget:
+            return
+        with self._lock:
+            previous = self._windows.pop(index, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._windows[index] = window
+            self.size += len(window)
+            while self.size > self.budget:
+                _, evicted = self._windows.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self.size = 0
+
+
+class SpillFile(object):
+    def __init__(self, limit, chunk_size=1024 * 1024):
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self._fd = None
+        self._map = None
+        # Set once the mapping exists, readers that see it can use the spill without the fill lock
+        self._filled = threading.Event()
+
+    def is_filled(self):
+        return self._filled.is_set()
+
+    def fill(self, stream, size, checksum=False):
+        if size > self.limit:
+            raise IOError("Spill size %d exceeds limit %d" % (size, self.limit))
+        # The file is only published once completely written, a failed fill leaves the spill empty
+        fd = tempfile.TemporaryFile()
+        try:
+            crc = 0
+            remaining = size
+            while remaining > 0:
+                chunk = stream.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise IOError("Decoded stream ended %d bytes early" % remaining)
+                if checksum:
+                    crc = zlib.crc32(chunk, crc)
+                fd.write(chunk)
+                remaining -= len(chunk)
+            fd.flush()
+            if size > 0:
+                self._map = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+        except BaseException:
+            fd.close()
+            raise
+        self._fd = fd
+        self._filled.set()
+        return crc if checksum else None
+
+    def get(self, offset, size):
+        if self._map is None:
+            return b""
+        return self._map[offset:offset + size]
+
+    def close(self):
+        self._filled.clear()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
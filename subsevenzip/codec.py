@@ -12,12 +12,50 @@
 # OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
+import io
+import bz2
 import lzma
+import zlib
+from functools import partial
+from collections import deque
 
+from .enums import CodecId
 from .exceptions import BadSevenZipArchive
+from .buffer import UINT32, ForwardStream
 
+BCJ_FILTERS = {
+    CodecId.BCJ_X86_FILTER: lzma.FILTER_X86,
+    CodecId.BCJ_PPC_FILTER: lzma.FILTER_POWERPC,
+    CodecId.BCJ_IA64_FILTER: lzma.FILTER_IA64,
+    CodecId.BCJ_ARM_FILTER: lzma.FILTER_ARM,
+    CodecId.BCJ_ARM_THUMB_FILTER: lzma.FILTER_ARMTHUMB,
+    CodecId.BCJ_SPARC_FILTER: lzma.FILTER_SPARC
+}
+
+
+def filter_chain(coders):
+    filters = []
+    for codec, properties in coders:
+        if codec == CodecId.DELTA_FILTER:
+            if len(properties) != 1:
+                raise BadSevenZipArchive("Corrupt Delta properties")
+            filters.append({"id": lzma.FILTER_DELTA, "dist": properties[0] + 1})
+        elif codec in BCJ_FILTERS:
+            options = {"id": BCJ_FILTERS[codec]}
+            if len(properties) == 4:
+                options["start_offset"] = UINT32.unpack(properties)[0]
+            elif properties:
+                raise BadSevenZipArchive("Corrupt BCJ properties")
+            filters.append(options)
+        else:
+            raise NotImplementedError("Codec %s not supported as a filter" % codec)
+    return filters
+
+
+def open_lzma_stream(stream, properties, filters=(), executor=None, lookahead=2, segment_limit=None):
+    if len(properties) != 5:
+        raise BadSevenZipArchive("Corrupt LZMA properties")
 
-def open_lzma_stream(stream, properties):
     options = properties[0] & 0xff
 
     pb = int(options / (9 * 5))
@@ -41,10 +79,342 @@ def open_lzma_stream(stream, properties):
     if not 4096 <= dict_size < (2**30 + 2**29):
         raise BadSevenZipArchive("Corrupt LZMA dictionary size (%d)" % dict_size)
 
-    return lzma.LZMAFile(stream, format=lzma.FORMAT_RAW, filters=[{
+    return lzma.LZMAFile(stream, format=lzma.FORMAT_RAW, filters=list(filters) + [{
         "id": lzma.FILTER_LZMA1,
         "dict_size": dict_size,
         "pb": pb,
         "lp": lp,
         "lc": lc
     }])
+
+
+def lzma2_filters(properties):
+    if len(properties) != 1:
+        raise BadSevenZipArchive("Corrupt LZMA2 properties")
+
+    dict_bits = properties[0] & 0x3f
+    if dict_bits > 40:
+        raise BadSevenZipArchive("Corrupt LZMA2 dictionary size")
+
+    if dict_bits == 40:
+        dict_size = 0xffffffff
+    else:
+        dict_size = (2 | (dict_bits & 1)) << (dict_bits // 2 + 11)
+
+    return [{
+        "id": lzma.FILTER_LZMA2,
+        "dict_size": dict_size
+    }]
+
+
+# Segments decoding to more than this are decoded serially, so memory stays bounded when the encoder
+# only reset the dictionary rarely or never, as single threaded encoders do
+SEGMENT_LIMIT = 8 * 1024 * 1024
+
+# Multithreaded 7-Zip resets the dictionary every few dictionary sizes, the derived limit is capped here
+MAX_SEGMENT_LIMIT = 256 * 1024 * 1024
+
+
+def iter_lzma2_segments(stream, limit=None):
+    # Splits an LZMA2 stream into segments that each start with a dictionary reset and new
+    # properties, which makes every segment decodable on its own. Yields the stream range,
+    # compressed data and decoded size of each segment. Only the chunk headers of a segment
+    # decoding to more than limit are read and its data is None. The stream may be moved
+    # between segments.
+    start = stream.tell()
+    segment = bytearray()
+    size = 0
+    while True:
+        position = stream.tell()
+        header = bytearray(stream.read(1))
+        if not header:
+            raise BadSevenZipArchive("LZMA2 stream ended without end marker")
+        control = header[0]
+        if control == 0x00:
+            break
+        elif control in (0x01, 0x02):
+            header += stream.read(2)
+            unpacked = packed = ((header[1] << 8) | header[2]) + 1
+        elif control >= 0x80:
+            header += stream.read(4 if control < 0xc0 else 5)
+            unpacked = (((control & 0x1f) << 16) | (header[1] << 8) | header[2]) + 1
+            packed = ((header[3] << 8) | header[4]) + 1
+            if control >= 0xe0 and position > start:
+                yield start, position, None if segment is None else bytes(segment), size
+                stream.seek(position + len(header))
+                start = position
+                segment = bytearray()
+                size = 0
+        else:
+            raise BadSevenZipArchive("Corrupt LZMA2 chunk (control: 0x%02x)" % control)
+        size += unpacked
+        if limit is not None and size > limit:
+            segment = None
+        if segment is None:
+            stream.seek(packed, io.SEEK_CUR)
+        else:
+            segment += header
+            segment += stream.read(packed)
+    if position > start:
+        yield start, position, None if segment is None else bytes(segment), size
+
+
+def decode_lzma2_segment(segment, filters):
+    return lzma.decompress(segment + b"\x00", format=lzma.FORMAT_RAW, filters=filters)
+
+
+class SegmentSource(object):
+    # The compressed range of a single LZMA2 segment, terminated by an end marker
+    def __init__(self, stream, start, end):
+        self._stream = stream
+        self._pos = start
+        self._end = end
+        self._marker = b"\x00"
+
+    def read(self, size):
+        if self._pos == self._end:
+            marker, self._marker = self._marker, b""
+            return marker
+        # The segment scan moves the shared stream, so every read seeks
+        self._stream.seek(self._pos)
+        data = self._stream.read(min(size, self._end - self._pos))
+        if not data:
+            raise BadSevenZipArchive("LZMA2 stream truncated")
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class ParallelLZMA2Reader(ForwardStream):
+    kind = "parallel LZMA2 stream"
+
+    def __init__(self, stream, filters, executor, lookahead, segment_limit=SEGMENT_LIMIT):
+        self._stream = stream
+        self._segments = iter_lzma2_segments(stream, segment_limit)
+        self._filters = filters
+        self._executor = executor
+        # Decoded segments waiting to be read are bounded in bytes, not in segments
+        self._budget = lookahead * segment_limit
+        self._queued = 0
+        self._pending = deque()
+        self._next = None
+        self._serial = None
+        self._buffer = b""
+        self._buffer_pos = 0
+        self._pos = 0
+
+    def _submit(self):
+        # Compressed data is read on the calling thread, segments are decoded on the executor
+        while self._serial is None:
+            if self._next is None:
+                self._next = next(self._segments, None)
+                if self._next is None:
+                    return
+            start, end, segment, size = self._next
+            if segment is None:
+                if self._pending:
+                    return
+                # Only the oversized segment is streamed, the executor takes over again at the next reset
+                decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self._filters)
+                if not hasattr(decompressor, "needs_input"):
+                    decompressor = UnboundedDecompressor(decompressor)
+                self._serial = DecompressorReader(SegmentSource(self._stream, start, end), decompressor)
+                self._next = None
+                return
+            if self._pending and self._queued + size > self._budget:
+                return
+            self._pending.append((self._executor.submit(decode_lzma2_segment, segment, self._filters), size))
+            self._queued += size
+            self._next = None
+
+    def _fill(self):
+        while True:
+            self._submit()
+            if self._pending:
+                future, size = self._pending.popleft()
+                self._queued -= size
+                self._buffer = future.result()
+            elif self._serial is not None:
+                self._buffer = self._serial.read(64 * 1024)
+                if not self._buffer:
+                    self._serial.close()
+                    self._serial = None
+                    continue
+            else:
+                return False
+            self._buffer_pos = 0
+            return len(self._buffer) > 0
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        chunks = []
+        while size != 0:
+            if self._buffer_pos == len(self._buffer) and not self._fill():
+                break
+            available = len(self._buffer) - self._buffer_pos
+            step = available if size < 0 else min(available, size)
+            chunks.append(self._buffer[self._buffer_pos:self._buffer_pos + step])
+            self._buffer_pos += step
+            self._pos += step
+            if size > 0:
+                size -= step
+        return b"".join(chunks)
+
+    def _skip(self, count):
+        while count > 0:
+            if self._buffer_pos == len(self._buffer) and not self._fill():
+                break
+            step = min(count, len(self._buffer) - self._buffer_pos)
+            self._buffer_pos += step
+            self._pos += step
+            count -= step
+
+    def close(self):
+        for future, size in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+        self._buffer = b""
+        super().close()
+
+
+def open_lzma2_stream(stream, properties, filters=(), executor=None, lookahead=2, segment_limit=None):
+    # Filters carry state across LZMA2 segment boundaries, so filtered folders are decoded serially
+    if executor is None or filters:
+        return lzma.LZMAFile(stream, format=lzma.FORMAT_RAW, filters=list(filters) + lzma2_filters(properties))
+    filters = lzma2_filters(properties)
+    if segment_limit is None:
+        # Sized to the blocks multithreaded 7-Zip writes, about four dictionaries each
+        segment_limit = max(SEGMENT_LIMIT, min(4 * filters[0]["dict_size"], MAX_SEGMENT_LIMIT))
+    return ParallelLZMA2Reader(stream, filters, executor, lookahead, segment_limit)
+
+
+class RawDeflateDecompressor(object):
+    # Gives zlib the needs_input/max_length interface of the bz2 and lzma decompressors
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(-15)
+        self._pending = False
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+    @property
+    def needs_input(self):
+        # A call capped by max_length may leave output buffered in zlib even with all input consumed
+        return not self._decompressor.unconsumed_tail and not self._pending
+
+    def decompress(self, data, max_length=-1):
+        data = self._decompressor.decompress(self._decompressor.unconsumed_tail + data, max(max_length, 0))
+        self._pending = max_length > 0 and len(data) == max_length
+        return data
+
+
+class UnboundedDecompressor(object):
+    # Python 3.4 decompressors have no max_length, so their surplus output is held here
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+        self._buffer = b""
+        self._buffer_pos = 0
+
+    @property
+    def eof(self):
+        return self._decompressor.eof and self._buffer_pos == len(self._buffer)
+
+    @property
+    def needs_input(self):
+        return not self._decompressor.eof and self._buffer_pos == len(self._buffer)
+
+    def decompress(self, data, max_length=-1):
+        if data:
+            self._buffer = self._buffer[self._buffer_pos:] + self._decompressor.decompress(data)
+            self._buffer_pos = 0
+        end = len(self._buffer) if max_length < 0 else min(len(self._buffer), self._buffer_pos + max_length)
+        data = self._buffer[self._buffer_pos:end]
+        self._buffer_pos = end
+        return data
+
+
+class DecompressorReader(ForwardStream):
+    kind = "compressed stream"
+
+    def __init__(self, stream, decompressor, chunk_size=64 * 1024):
+        self._stream = stream
+        self._decompressor = decompressor
+        self._chunk_size = chunk_size
+        self._pos = 0
+
+    def _decompress(self, size):
+        data = b""
+        if self._decompressor.needs_input:
+            data = self._stream.read(self._chunk_size)
+            if not data:
+                raise BadSevenZipArchive("Compressed stream ended without end marker")
+        chunk = self._decompressor.decompress(data, size)
+        self._pos += len(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(partial(self.read, self._chunk_size), b""))
+        chunks = []
+        while size > 0 and not self._decompressor.eof:
+            chunk = self._decompress(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _skip(self, count):
+        end = self._pos + count
+        while self._pos < end and not self._decompressor.eof:
+            self._decompress(min(end - self._pos, self._chunk_size))
+
+    def close(self):
+        self._stream.close()
+        super().close()
+
+
+def open_copy_stream(stream, properties, filters=(), executor=None, lookahead=2, segment_limit=None):
+    # Stored data is served straight from the pack stream, which hands out slices of the mapping
+    return stream
+
+
+def open_deflate_stream(stream, properties, filters=(), executor=None, lookahead=2, segment_limit=None):
+    return DecompressorReader(stream, RawDeflateDecompressor())
+
+
+def open_bzip2_stream(stream, properties, filters=(), executor=None, lookahead=2, segment_limit=None):
+    decompressor = bz2.BZ2Decompressor()
+    if not hasattr(decompressor, "needs_input"):
+        decompressor = UnboundedDecompressor(decompressor)
+    return DecompressorReader(stream, decompressor)
+
+
+DECODERS = {
+    CodecId.COPY: open_copy_stream,
+    CodecId.LZMA: open_lzma_stream,
+    CodecId.LZMA2: open_lzma2_stream,
+    CodecId.DEFLATE: open_deflate_stream,
+    CodecId.BZIP2: open_bzip2_stream
+}
+
+# Only the liblzma based decoders can run filters in front of them
+FILTERABLE = (CodecId.LZMA, CodecId.LZMA2)
+
+
+def register_decoder(codec, factory):
+    DECODERS[CodecId(codec)] = factory
+
+
+def open_stream(stream, coders, executor=None, lookahead=2, segment_limit=None):
+    # Coders are ordered from the folder output to the pack stream, which is the order liblzma
+    # expects its filter chain in, so the whole chain is decoded in a single pass.
+    codec, properties = coders[-1]
+    if codec not in DECODERS:
+        raise NotImplementedError("Codec %s not supported" % codec)
+    return DECODERS[codec](stream, properties, filter_chain(coders[:-1]), executor, lookahead, segment_limit)
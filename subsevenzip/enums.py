@@ -58,3 +58,9 @@ class CodecId(bytes, Enum):
     BCJ_ARM_THUMB_FILTER = b'\x03\x03\x07\x01'
     BCJ_SPARC_FILTER = b'\x03\x03\x08\x05'
     DELTA_FILTER = b'\x03'
+
+
+class CrcMode(Enum):
+    OFF = "off"
+    VERIFY = "verify"
+    VERIFY_AND_RAISE = "verify-and-raise"
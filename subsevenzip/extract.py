@@ -0,0 +1,67 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import os
+import threading
+
+from .exceptions import BadSevenZipArchive
+
+
+def target_path(root, name):
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(name) or os.path.splitdrive(name)[0]:
+        raise BadSevenZipArchive("Refusing to extract unsafe path %r" % name)
+    return os.path.join(root, *parts)
+
+
+class TargetFile(object):
+    def __init__(self, path, size):
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+        self._lock = threading.Lock()
+        # The producer holds one reference until every chunk has been submitted
+        self._pending = 1
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self._fd, 0, size)
+            except OSError:
+                # Not every file system supports preallocation
+                pass
+
+    def submit(self, executor, data, offset):
+        with self._lock:
+            self._pending += 1
+        return executor.submit(self._write, data, offset)
+
+    def _write(self, data, offset):
+        try:
+            view = memoryview(data)
+            while view:
+                if hasattr(os, "pwrite"):
+                    written = os.pwrite(self._fd, view, offset)
+                else:
+                    with self._lock:
+                        os.lseek(self._fd, offset, os.SEEK_SET)
+                        written = os.write(self._fd, view)
+                view = view[written:]
+                offset += written
+        finally:
+            self.done()
+
+    def done(self):
+        with self._lock:
+            self._pending -= 1
+            last = self._pending == 0
+        if last:
+            os.close(self._fd)
@@ -0,0 +1,148 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import tempfile
+import builtins
+from array import array
+
+from .enums import CodecId
+from .buffer import MemoryReadBuffer
+from .bitvector import BitVector
+from .builder import FileTable
+
+MAGIC = b"7zIX\x04" + (b"L" if sys.byteorder == "little" else b"B")
+SIGNATURE_HEADER_SIZE = 32
+
+
+def index_key(signature_header, stat):
+    # The signature header carries the start header CRC and the next header offset, size and CRC
+    return signature_header + struct.pack("<QQ", stat.st_size, stat.st_mtime_ns)
+
+
+def index_path(directory, key):
+    return os.path.join(directory, hashlib.sha1(key).hexdigest() + ".7zi")
+
+
+def _pad(out):
+    out += bytes(-len(out) & 7)
+
+
+def dump_index(archive, key):
+    out = bytearray(MAGIC)
+    out += struct.pack("<H", len(key)) + key
+    out += struct.pack("<QI", archive["payload_offset"], len(archive["folders"]))
+    for folder in archive["folders"]:
+        out += struct.pack("<B", len(folder["coders"]))
+        for codec, properties in folder["coders"]:
+            out += struct.pack("<B", len(codec.value)) + codec.value
+            out += struct.pack("<H", len(properties)) + properties
+        out += struct.pack("<QQQ", folder["compressed_offset"], folder["compressed_size"], folder["decompressed_size"])
+        out += struct.pack("<BI", "checksum" in folder, folder.get("checksum", 0))
+
+    files = archive["files"]
+    names = "\0".join(name or "" for name in files.names).encode("utf-8", "surrogatepass")
+    out += struct.pack("<QQ", len(files), len(names))
+    # Columns are 8 byte aligned so the index can be used from a mapping
+    for column in (files.sizes, files.offsets, files.folders, files.checksums):
+        _pad(out)
+        out += column.tobytes()
+    _pad(out)
+    out += files.empty_stream_mask.tobytes()
+    out += files.checksum_mask.tobytes()
+    out += files.directory_mask.tobytes()
+    out += names
+    return bytes(out)
+
+
+def load_index(data, key):
+    buf = MemoryReadBuffer(data)
+    try:
+        return _load_index(buf, key)
+    finally:
+        buf.release()
+
+
+def _load_index(buf, key):
+    if buf.get_bytes(len(MAGIC)) != MAGIC:
+        return None
+    if buf.get_bytes(buf.get_uint16()) != key:
+        return None
+
+    archive = {
+        "payload_offset": buf.get_uint64(),
+        "folders": []
+    }
+    for x in range(buf.get_uint32()):
+        coders = list()
+        for y in range(buf.get_uint8()):
+            codec = CodecId(buf.get_bytes(buf.get_uint8()))
+            coders.append((codec, buf.get_bytes(buf.get_uint16())))
+        folder = {
+            "coders": coders,
+            "compressed_offset": buf.get_uint64(),
+            "compressed_size": buf.get_uint64(),
+            "decompressed_size": buf.get_uint64()
+        }
+        has_checksum = buf.get_uint8()
+        checksum = buf.get_uint32()
+        if has_checksum:
+            folder["checksum"] = checksum
+        archive["folders"].append(folder)
+
+    n_files = buf.get_uint64()
+    names_size = buf.get_uint64()
+    columns = []
+    for typecode in "QQII":
+        buf.seek(-buf.tell() & 7)
+        column = array(typecode)
+        column.frombytes(buf.get_bytes(n_files * column.itemsize))
+        columns.append(column)
+    buf.seek(-buf.tell() & 7)
+    empty_stream_mask = BitVector(buf.get_bytes((n_files + 7) // 8), n_files)
+    checksum_mask = BitVector(buf.get_bytes((n_files + 7) // 8), n_files)
+    directory_mask = BitVector(buf.get_bytes((n_files + 7) // 8), n_files)
+    names = buf.get_bytes(names_size).decode("utf-8", "surrogatepass").split("\0") if n_files else []
+    if len(names) != n_files or len(columns[0]) != n_files:
+        raise IOError("Truncated index")
+
+    archive["files"] = FileTable(names, columns[0], columns[1], columns[2], empty_stream_mask,
+                                 columns[3], checksum_mask, directory_mask)
+    return archive
+
+
+def read_index(directory, key):
+    try:
+        with builtins.open(index_path(directory, key), "rb") as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return load_index(data, key)
+    except (IOError, ValueError, struct.error):
+        # Missing, stale or damaged indexes are rebuilt from the archive
+        return None
+
+
+def write_index(directory, key, archive):
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(dump_index(archive, key))
+        os.replace(path, index_path(directory, key))
+    except BaseException:
+        os.unlink(path)
+        raise
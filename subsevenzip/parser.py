@@ -12,41 +12,46 @@
 # OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
-import io
+import zlib
 import struct
 import binascii
+from bisect import bisect_right
+from itertools import accumulate
 
 from .enums import PropertyId, CodecId
 from .exceptions import BadSevenZipArchive
-from .codec import open_lzma_stream
-from .builder import FilesInfoBuilder
-from .buffer import ReadBuffer
+from .codec import open_stream, DECODERS, FILTERABLE, BCJ_FILTERS
+from .builder import FilesInfoBuilder, LazyFileTable, directory_mask
+from .bitvector import BitVector
+from .buffer import MemoryReadBuffer
+from .stats import timer
+
+
+def parse_digests(buf, count):
+    defined = buf.get_all_or_bits(count)
+    return [buf.get_uint32() if is_defined else None for is_defined in defined]
 
 
 def parse_pack_info(buf, archive):
     archive["compressed_offset"] = buf.get_varint()
 
     n_streams = buf.get_varint()
-    if n_streams != 1:
-        raise NotImplementedError("Only single stream files supported (n_streams: %d)" % n_streams)
+    archive["compressed_sizes"] = [0] * n_streams
 
     nid = buf.get_uint8()
     if nid == PropertyId.kSize:
-        archive["compressed_size"] = buf.get_varint()
+        archive["compressed_sizes"] = [buf.get_varint() for x in range(n_streams)]
         nid = buf.get_uint8()
 
     if nid == PropertyId.kCRC:
-        raise NotImplementedError("CRC for PackInfo not supported")
+        parse_digests(buf, n_streams)
+        nid = buf.get_uint8()
 
     if nid != PropertyId.kEnd:
         raise BadSevenZipArchive.mismatch(PropertyId.kEnd, nid)
 
 
-def parse_folder(buf):
-    n_coders = buf.get_varint()
-    if n_coders != 1:
-        raise NotImplementedError("Only support folders with one coder")
-
+def parse_coder(buf):
     codec_size = lambda x: x & 0xf
     is_complex = lambda x: (x & 0x10) != 0
     has_properties = lambda x: (x & 0x20) != 0
@@ -58,19 +63,65 @@ def parse_folder(buf):
         raise NotImplementedError("Deprecated 7zip feature")
 
     codec = CodecId(buf.get_bytes(codec_size(flags)))
-    if codec != CodecId.LZMA:
-        raise NotImplementedError("Codec %s not supported" % codec)
 
+    n_in_streams = n_out_streams = 1
     if is_complex(flags):
-        raise NotImplementedError("Multiple I/O streams not supported")
+        n_in_streams = buf.get_varint()
+        n_out_streams = buf.get_varint()
 
-    if not has_properties(flags):
-        raise NotImplementedError("Only LZMA is supported, which has properties")
+    properties_bytes = b""
+    if has_properties(flags):
+        properties_bytes = buf.get_bytes(buf.get_varint())
 
-    properties_size = buf.get_varint()
-    properties_bytes = buf.get_bytes(properties_size)
+    return codec, properties_bytes, n_in_streams, n_out_streams
 
-    return codec, properties_bytes
+
+def parse_folder(buf):
+    n_coders = buf.get_varint()
+    coders = [parse_coder(buf) for x in range(n_coders)]
+
+    n_in_streams = sum(coder[2] for coder in coders)
+    n_out_streams = sum(coder[3] for coder in coders)
+
+    bind_pairs = dict()
+    for x in range(n_out_streams - 1):
+        in_index = buf.get_varint()
+        bind_pairs[in_index] = buf.get_varint()
+
+    n_packed_streams = n_in_streams - len(bind_pairs)
+    if n_packed_streams > 1:
+        for x in range(n_packed_streams):
+            buf.get_varint()
+
+    if n_packed_streams != 1 or n_in_streams != n_coders or n_out_streams != n_coders:
+        raise NotImplementedError("Only folders with a linear chain of coders are supported")
+
+    # Simple coders have one in and one out stream, both numbered by the coder index. Walk the
+    # chain from the one output that isn't bound, which is the folder output, to the pack stream.
+    bound = set(bind_pairs.values())
+    main_stream = [index for index in range(n_out_streams) if index not in bound]
+    if len(main_stream) != 1:
+        raise BadSevenZipArchive("Folder has %d unbound output streams" % len(main_stream))
+
+    chain = list()
+    index = main_stream[0]
+    while index is not None and len(chain) < n_coders:
+        chain.append(index)
+        index = bind_pairs.get(index)
+    if index is not None or len(chain) != n_coders:
+        raise BadSevenZipArchive("Folder bind pairs don't form a chain")
+
+    codec = coders[chain[-1]][0]
+    if codec not in DECODERS:
+        raise NotImplementedError("Codec %s not supported" % codec)
+
+    for index in chain[:-1]:
+        if codec not in FILTERABLE:
+            raise NotImplementedError("Filters in front of %s not supported" % codec)
+        if coders[index][0] not in BCJ_FILTERS and coders[index][0] != CodecId.DELTA_FILTER:
+            raise NotImplementedError("Codec %s not supported as a filter" % coders[index][0])
+
+    return [coders[index][:2] for index in chain], main_stream[0]
 
 
 def parse_unpack_info(buf, archive):
@@ -79,72 +130,127 @@ def parse_unpack_info(buf, archive):
         raise BadSevenZipArchive.mismatch(PropertyId.kFolder, nid)
 
     n_folders = buf.get_varint()
-    if n_folders != 1:
-        raise NotImplementedError("Only support one folder structure per archive")
 
     external = buf.get_uint8()
     if external != 0:
         raise NotImplementedError("External not supported")
 
-    archive["codec"], archive["codec_properties"] = parse_folder(buf)
+    folders = list()
+    main_streams = list()
+    for x in range(n_folders):
+        coders, main_stream = parse_folder(buf)
+        folders.append({
+            "coders": coders
+        })
+        main_streams.append(main_stream)
 
     nid = buf.get_uint8()
     if nid != PropertyId.kCodersUnpackSize:
         raise BadSevenZipArchive.mismatch(PropertyId.kCodersUnpackSize, nid)
 
-    archive["decompressed_size"] = buf.get_varint()
+    # There is one size per coder output, the folder size is the one of the unbound output
+    for folder, main_stream in zip(folders, main_streams):
+        sizes = [buf.get_varint() for x in folder["coders"]]
+        folder["decompressed_size"] = sizes[main_stream]
 
     nid = buf.get_uint8()
     if nid == PropertyId.kCRC:
-        has_crc = buf.get_all_or_bits(n_folders)
-        if has_crc > 0:
-            archive["checksum"] = buf.get_uint32()
-            nid = buf.get_uint8()
+        for folder, checksum in zip(folders, parse_digests(buf, n_folders)):
+            if checksum is not None:
+                folder["checksum"] = checksum
+        nid = buf.get_uint8()
 
     if nid != PropertyId.kEnd:
         raise BadSevenZipArchive.mismatch(PropertyId.kEnd, nid)
 
+    archive["folders"] = folders
 
-def parse_substreams_info(buf, archive):
-    nid = buf.get_uint8()
-    if nid != PropertyId.kNumUnpackStream:
-        raise BadSevenZipArchive.mismatch(PropertyId.kNumUnpackStream, nid)
 
-    n_substreams = buf.get_varint()
-    if n_substreams < 1:
-        raise NotImplementedError("Only 1...n substreams supported")
+def parse_substreams_info(buf, archive):
+    folders = archive["folders"]
+    n_substreams = [1] * len(folders)
 
     nid = buf.get_uint8()
-    if nid != PropertyId.kSize:
-        raise BadSevenZipArchive.mismatch(PropertyId.kSize, nid)
+    if nid == PropertyId.kNumUnpackStream:
+        n_substreams = [buf.get_varint() for folder in folders]
+        nid = buf.get_uint8()
 
+    substream_folders = list()
     sizes = list()
 
-    accumulated_size = 0
-    for x in range(n_substreams - 1):
-        size = buf.get_varint()
-        sizes.append(size)
-        accumulated_size += size
+    for index, folder in enumerate(folders):
+        if n_substreams[index] == 0:
+            continue
+        accumulated_size = 0
+        for x in range(n_substreams[index] - 1):
+            size = buf.get_varint() if nid == PropertyId.kSize else 0
+            sizes.append(size)
+            accumulated_size += size
+        sizes.append(folder["decompressed_size"] - accumulated_size)
+        substream_folders.extend([index] * n_substreams[index])
 
-    sizes.append(archive["decompressed_size"] - accumulated_size)
+    if nid == PropertyId.kSize:
+        nid = buf.get_uint8()
 
+    archive["substream_folders"] = substream_folders
     archive["decompressed_sizes"] = sizes
 
-    nid = buf.get_uint8()
-    if nid != PropertyId.kCRC:
-        raise BadSevenZipArchive.mismatch(PropertyId.kCRC, nid)
+    digests = iter(())
+    if nid == PropertyId.kCRC:
+        # Folders with a single substream and a known CRC don't repeat it here
+        n_digests = sum(n for n, folder in zip(n_substreams, folders) if n != 1 or "checksum" not in folder)
+        digests = iter(parse_digests(buf, n_digests))
+        nid = buf.get_uint8()
+
+    checksums = list()
+    for n, folder in zip(n_substreams, folders):
+        if n == 1 and "checksum" in folder:
+            checksums.append(folder["checksum"])
+        else:
+            checksums.extend(next(digests, None) for x in range(n))
+
+    archive["checksums"] = checksums
 
-    missing_crc = buf.get_all_or_bits(n_substreams)
-    for x in range(n_substreams):
-        if ((1 << x) & missing_crc) != 0:
-            buf.get_uint32()
+    if nid != PropertyId.kEnd:
+        raise BadSevenZipArchive.mismatch(PropertyId.kEnd, nid)
+
+
+def parse_substreams_positions(buf, archive):
+    # Lazy counterpart of parse_substreams_info, only records where the sizes and digests are
+    folders = archive["folders"]
+    counts = [1] * len(folders)
 
     nid = buf.get_uint8()
+    if nid == PropertyId.kNumUnpackStream:
+        counts = [buf.get_varint() for folder in folders]
+        nid = buf.get_uint8()
+
+    size_positions = None
+    if nid == PropertyId.kSize:
+        size_positions = list()
+        for n in counts:
+            size_positions.append(buf.tell())
+            buf.skip_varints(max(n - 1, 0))
+        nid = buf.get_uint8()
+
+    digests_position = None
+    if nid == PropertyId.kCRC:
+        n_digests = sum(n for n, folder in zip(counts, folders) if n != 1 or "checksum" not in folder)
+        digests_position = buf.tell()
+        buf.seek(4 * buf.get_all_or_bits(n_digests).count())
+        nid = buf.get_uint8()
+
     if nid != PropertyId.kEnd:
         raise BadSevenZipArchive.mismatch(PropertyId.kEnd, nid)
 
+    archive["substreams"] = {
+        "counts": counts,
+        "size_positions": size_positions,
+        "digests_position": digests_position
+    }
+
 
-def parse_streams_info(buf, archive):
+def parse_streams_info(buf, archive, lazy=False):
     nid = buf.get_uint8()
     if nid != PropertyId.kPackInfo:
         raise BadSevenZipArchive.mismatch(PropertyId.kPackInfo, nid)
@@ -157,9 +263,33 @@ def parse_streams_info(buf, archive):
 
     parse_unpack_info(buf, archive)
 
+    if len(archive["folders"]) != len(archive["compressed_sizes"]):
+        raise BadSevenZipArchive("Folder count %d does not match pack stream count %d" % (
+            len(archive["folders"]), len(archive["compressed_sizes"])))
+
+    # Every folder has a single pack stream, and thus consumes the pack streams in order
+    offset = archive["compressed_offset"]
+    for folder, size in zip(archive["folders"], archive["compressed_sizes"]):
+        folder["compressed_offset"] = offset
+        folder["compressed_size"] = size
+        offset += size
+
+    archive["substream_folders"] = list(range(len(archive["folders"])))
+    archive["decompressed_sizes"] = [folder["decompressed_size"] for folder in archive["folders"]]
+    archive["checksums"] = [folder.get("checksum") for folder in archive["folders"]]
+    if lazy:
+        archive["substreams"] = {
+            "counts": [1] * len(archive["folders"]),
+            "size_positions": None,
+            "digests_position": None
+        }
+
     nid = buf.get_uint8()
     if nid == PropertyId.kSubStreamsInfo:
-        parse_substreams_info(buf, archive)
+        if lazy:
+            parse_substreams_positions(buf, archive)
+        else:
+            parse_substreams_info(buf, archive)
         nid = buf.get_uint8()
 
     if nid != PropertyId.kEnd:
@@ -171,10 +301,24 @@ def parse_streams_info(buf, archive):
 def parse_encoded_header(buf, payload_position):
     archive = {}
     parse_streams_info(buf, archive)
-    header_offset = payload_position + archive["compressed_offset"]
-    buf.seek(header_offset, whence=io.SEEK_SET)
-    with open_lzma_stream(buf.get_sub_stream(archive["compressed_size"]), archive["codec_properties"]) as fd:
-        return fd.read(archive["decompressed_size"])
+    header = bytearray()
+    for folder in archive["folders"]:
+        stream = buf.get_sub_stream(folder["compressed_size"], payload_position + folder["compressed_offset"])
+        with open_stream(stream, folder["coders"]) as fd:
+            data = fd.read(folder["decompressed_size"])
+        if "checksum" in folder and folder["checksum"] != zlib.crc32(data) & 0xffffffff:
+            raise BadSevenZipArchive("Header checksum failed")
+        header += data
+    return bytes(header)
+
+
+def parse_names(buf, size, n_files):
+    data = buf.get_bytes(size)
+    # A trailing odd byte can't belong to a terminated name
+    names = data[:len(data) & ~1].decode("utf-16-le").split("\0")
+    if len(names) <= n_files:
+        raise IOError("Expected %d \\0 terminated UTF-16 names, got %d" % (n_files, len(names) - 1))
+    return names[:n_files]
 
 
 def parse_files_info(buf, archive):
@@ -190,31 +334,140 @@ def parse_files_info(buf, archive):
         buf.set_limit(size)
         if nid == PropertyId.kEmptyStream:
             fib.set_empty_stream_mask(buf.get_bits(n_files))
+        elif nid == PropertyId.kEmptyFile:
+            fib.set_empty_file_mask(buf.get_bits(fib.empty_stream_mask.count()))
         elif nid == PropertyId.kName:
             if buf.get_uint8() != 0:
                 raise NotImplementedError("External FilesInfo kName not supported")
-            for index in range(n_files):
-                fib.set_name(index, buf.get_utf16_le())
+            for index, name in enumerate(parse_names(buf, size - 1, n_files)):
+                fib.set_name(index, name)
         else:
             buf.seek(size)
         buf.unset_limit()
 
     offset = 0
-    it = iter(archive["decompressed_sizes"])
+    previous_folder = None
+    it = zip(archive.get("substream_folders", []), archive.get("decompressed_sizes", []), archive.get("checksums", []))
 
     for index in range(n_files):
-        if ((1 << index) & fib.empty_stream_mask) == 0:
-            size = next(it)
+        if not fib.empty_stream_mask[index]:
+            folder, size, checksum = next(it)
+            if folder != previous_folder:
+                offset = 0
+                previous_folder = folder
             fib.set_size(index, size)
             fib.set_offset(index, offset)
+            fib.set_folder(index, folder)
+            if checksum is not None:
+                fib.set_checksum(index, checksum)
             offset += size
 
     archive["files"] = fib.build()
 
 
-def parse_header(buf, payload_offset):
+class DeferredFilesInfo(object):
+    # Decodes parts of FilesInfo on demand, from the positions recorded by parse_files_positions
+    def __init__(self, buf, archive, n_files, blocks):
+        self._buf = buf
+        self._archive = archive
+        self._n_files = n_files
+        self._blocks = blocks
+        self._folders = archive["folders"]
+        substreams = archive.get("substreams", {"counts": [], "size_positions": None, "digests_position": None})
+        self._counts = substreams["counts"]
+        self._size_positions = substreams["size_positions"]
+        self._digests_position = substreams["digests_position"]
+        self._starts = [0] + list(accumulate(self._counts))[:-1]
+        # Folders with a single substream and a known CRC have no digest in SubStreamsInfo
+        n_digests = [n if n != 1 or "checksum" not in folder else 0 for n, folder in zip(self._counts, self._folders)]
+        self._digest_starts = [0] + list(accumulate(n_digests))[:-1]
+        self._n_digests = sum(n_digests)
+        self._digests = None
+        self._folder_cache = None
+
+    def _block(self, nid):
+        if nid not in self._blocks:
+            return None, 0
+        position, size = self._blocks[nid]
+        return self._buf.fork(position), size
+
+    def names(self):
+        buf, size = self._block(PropertyId.kName)
+        if buf is None:
+            return [None] * self._n_files
+        if buf.get_uint8() != 0:
+            raise NotImplementedError("External FilesInfo kName not supported")
+        return parse_names(buf, size - 1, self._n_files)
+
+    def empty_stream_mask(self):
+        buf, size = self._block(PropertyId.kEmptyStream)
+        return BitVector.zeros(self._n_files) if buf is None else buf.get_bits(self._n_files)
+
+    def directory_mask(self):
+        empty_stream_mask = self.empty_stream_mask()
+        buf, size = self._block(PropertyId.kEmptyFile)
+        empty_file_mask = None if buf is None else buf.get_bits(empty_stream_mask.count())
+        return directory_mask(self._n_files, empty_stream_mask, empty_file_mask)
+
+    def _folder_sizes(self, folder):
+        cached = self._folder_cache
+        if cached is not None and cached[0] == folder:
+            return cached[1], cached[2]
+        sizes = [0] * (self._counts[folder] - 1)
+        if self._size_positions is not None:
+            buf = self._buf.fork(self._size_positions[folder])
+            sizes = [buf.get_varint() for size in sizes]
+        sizes.append(self._folders[folder]["decompressed_size"] - sum(sizes))
+        offsets = [0] + list(accumulate(sizes))[:-1]
+        self._folder_cache = folder, sizes, offsets
+        return sizes, offsets
+
+    def _checksum(self, folder, position):
+        if self._counts[folder] == 1 and "checksum" in self._folders[folder]:
+            return self._folders[folder]["checksum"]
+        if self._digests_position is None:
+            return None
+        index = self._digest_starts[folder] + position
+        if self._digests is None:
+            buf = self._buf.fork(self._digests_position)
+            if buf.get_uint8():
+                # All digests are defined, so they can be indexed directly
+                buf.seek(4 * index)
+                return buf.get_uint32()
+            self._digests = parse_digests(self._buf.fork(self._digests_position), self._n_digests)
+        return self._digests[index]
+
+    def locate(self, stream):
+        folder = bisect_right(self._starts, stream) - 1
+        position = stream - self._starts[folder]
+        sizes, offsets = self._folder_sizes(folder)
+        return sizes[position], offsets[position], folder, self._checksum(folder, position)
+
+    def columns(self):
+        files = parse_header(self._buf.fork(self._archive["header_position"]), self._archive["payload_offset"])["files"]
+        return files.sizes, files.offsets, files.folders, files.checksums, files.checksum_mask
+
+
+def parse_files_positions(buf, archive):
+    n_files = buf.get_varint()
+    blocks = dict()
+
+    while True:
+        nid = buf.get_uint8()
+        if nid == PropertyId.kEnd:
+            break
+        size = buf.get_varint()
+        blocks[nid] = (buf.tell(), size)
+        buf.seek(size)
+
+    archive["files"] = LazyFileTable(n_files, DeferredFilesInfo(buf, archive, n_files, blocks))
+
+
+def parse_header(buf, payload_offset, lazy=False):
     archive = {
-        "payload_offset": payload_offset
+        "payload_offset": payload_offset,
+        "header_position": buf.tell(),
+        "folders": []
     }
 
     nid = buf.get_uint8()
@@ -225,11 +478,14 @@ def parse_header(buf, payload_offset):
         raise NotImplementedError("AdditionalStreamsInfo not supported")
 
     if nid == PropertyId.kMainStreamsInfo:
-        parse_streams_info(buf, archive)
+        parse_streams_info(buf, archive, lazy)
         nid = buf.get_uint8()
 
     if nid == PropertyId.kFilesInfo:
-        parse_files_info(buf, archive)
+        if lazy:
+            parse_files_positions(buf, archive)
+        else:
+            parse_files_info(buf, archive)
         nid = buf.get_uint8()
 
     if nid != PropertyId.kEnd:
@@ -259,11 +515,12 @@ def parse_signature_header(buf):
     if crc != binascii.crc32(start_header) & 0xffffffff:
         raise BadSevenZipArchive("StartHeader checksum failed")
 
-    return parse_start_header(ReadBuffer(io.BytesIO(start_header)))
+    return parse_start_header(MemoryReadBuffer(start_header))
 
 
-def parse_headers(buf):
-    next_header_offset, next_header_size, _ = parse_signature_header(buf)
+def parse_headers(buf, stats=None, lazy=False):
+    with timer(stats, "signature"):
+        next_header_offset, next_header_size, _ = parse_signature_header(buf)
 
     payload_offset = buf.tell()
 
@@ -274,11 +531,13 @@ def parse_headers(buf):
         raise BadSevenZipArchive.mismatch(PropertyId.kEncodedHeader, nid)
 
     buf.set_limit(next_header_size)
-    decoded_header = ReadBuffer(io.BytesIO(parse_encoded_header(buf, payload_offset)))
+    with timer(stats, "header_decode"):
+        decoded_header = MemoryReadBuffer(parse_encoded_header(buf, payload_offset))
     buf.unset_limit()
 
     nid = decoded_header.get_uint8()
     if nid != PropertyId.kHeader:
         raise BadSevenZipArchive.mismatch(PropertyId.kHeader, nid)
 
-    return parse_header(decoded_header, payload_offset)
+    with timer(stats, "header_parse"):
+        return parse_header(decoded_header, payload_offset, lazy)
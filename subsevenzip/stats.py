@@ -0,0 +1,118 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import io
+import time
+import threading
+from collections import Counter
+
+from .buffer import ReadStream
+
+
+class Stats(object):
+    def __init__(self, callback=None):
+        self.counters = Counter()
+        self.timings = Counter()
+        self.callback = callback
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+        if self.callback is not None:
+            self.callback("count", name, value)
+
+    def record(self, phase, elapsed):
+        with self._lock:
+            self.timings[phase] += elapsed
+        if self.callback is not None:
+            self.callback("time", phase, elapsed)
+
+    def timer(self, phase):
+        return Timer(self, phase)
+
+    def snapshot(self):
+        with self._lock:
+            return {"counters": dict(self.counters), "timings": dict(self.timings)}
+
+    def __repr__(self):
+        return "Stats(%s)" % self.snapshot()
+
+
+class Timer(object):
+    __slots__ = ("_stats", "_phase", "_start")
+
+    def __init__(self, stats, phase):
+        self._stats = stats
+        self._phase = phase
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._stats.record(self._phase, time.perf_counter() - self._start)
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(stats, phase):
+    # Disabled stats cost a call and an empty with block
+    return NULL_TIMER if stats is None else stats.timer(phase)
+
+
+class TracedStream(ReadStream):
+    def __init__(self, stream, stats):
+        self._stream = stream
+        self._stats = stats
+        stats.count("decoder_starts")
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._stats.count("bytes_decoded", len(data))
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = self._stream.tell()
+        if whence == io.SEEK_CUR:
+            offset += position
+        elif whence != io.SEEK_SET:
+            return self._stream.seek(offset, whence)
+        if offset < position:
+            # Decoders rewind to the start of the folder to go backward
+            self._stats.count("decoder_restarts")
+            position = 0
+        result = self._stream.seek(offset)
+        self._stats.count("bytes_skipped", result - position)
+        self._stats.count("bytes_decoded", result - position)
+        return result
+
+    def tell(self):
+        return self._stream.tell()
+
+    def close(self):
+        self._stream.close()
+        super().close()
@@ -0,0 +1,112 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import os
+import builtins
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+from .buffer import PositionalStream
+
+
+def volume_paths(path):
+    # archive.7z.001 picks up .002, .003, ... for as long as they exist
+    base, extension = os.path.splitext(path)
+    if not extension[1:].isdigit() or int(extension[1:]) != 1:
+        return [path]
+    paths = []
+    width = len(extension) - 1
+    while os.path.exists("%s.%0*d" % (base, width, len(paths) + 1)):
+        paths.append("%s.%0*d" % (base, width, len(paths) + 1))
+    return paths
+
+
+class VolumeStream(PositionalStream):
+    def __init__(self, paths, max_open=8):
+        if not paths:
+            raise ValueError("No volumes given")
+        self._paths = list(paths)
+        self._starts = []
+        offset = 0
+        for path in self._paths:
+            self._starts.append(offset)
+            offset += os.path.getsize(path)
+        self._size = offset
+        self._max_open = max_open
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._pos = 0
+
+    def _acquire(self, index):
+        with self._lock:
+            entry = self._handles.get(index)
+            if entry is None:
+                entry = self._handles[index] = [builtins.open(self._paths[index], "rb", buffering=0), 0, False]
+                while len(self._handles) > self._max_open:
+                    evicted = self._handles.popitem(last=False)[1]
+                    evicted[2] = True
+                    if evicted[1] == 0:
+                        evicted[0].close()
+            else:
+                self._handles.move_to_end(index)
+            entry[1] += 1
+            return entry
+
+    def _release(self, entry):
+        # Handles evicted while a read was using them are closed by the last reader
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0 and entry[2]:
+                entry[0].close()
+
+    def _read_volume(self, index, size, offset):
+        entry = self._acquire(index)
+        try:
+            if hasattr(os, "pread"):
+                return os.pread(entry[0].fileno(), size, offset)
+            with self._lock:
+                entry[0].seek(offset)
+                return entry[0].read(size)
+        finally:
+            self._release(entry)
+
+    def pread(self, size, offset):
+        chunks = []
+        size = max(min(size, self._size - offset), 0)
+        while size > 0:
+            index = bisect_right(self._starts, offset) - 1
+            end = self._starts[index + 1] if index + 1 < len(self._starts) else self._size
+            data = self._read_volume(index, min(size, end - offset), offset - self._starts[index])
+            if not data:
+                raise IOError("Volume %s is shorter than when it was opened" % self._paths[index])
+            chunks.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        data = self.pread(size, self._pos)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        with self._lock:
+            entries, self._handles = list(self._handles.values()), OrderedDict()
+        for entry in entries:
+            entry[0].close()
+        super().close()
@@ -0,0 +1,279 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+
+import io
+import lzma
+import zlib
+import struct
+import builtins
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .enums import PropertyId, CodecId
+
+SIGNATURE = b"7z\xbc\xaf\x27\x1c\x00\x04"
+SIGNATURE_HEADER_SIZE = 32
+UINT32 = struct.Struct("<I")
+
+
+def encode_varint(value):
+    for n in range(8):
+        if value < 1 << (7 * (n + 1)):
+            return bytes([((0xff00 >> n) & 0xff) | (value >> (8 * n))]) + \
+                (value & ((1 << 8 * n) - 1)).to_bytes(n, "little")
+    return b"\xff" + value.to_bytes(8, "little")
+
+
+def encode_bits(flags):
+    out = bytearray((len(flags) + 7) // 8)
+    for index, flag in enumerate(flags):
+        if flag:
+            out[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(out)
+
+
+def lzma2_dict_bits(dict_size):
+    for bits in range(40):
+        if (2 | (bits & 1)) << (bits // 2 + 11) >= dict_size:
+            return bits
+    return 40
+
+
+def coder_filters(codec, preset, dict_size):
+    if codec == CodecId.LZMA:
+        filters = [{"id": lzma.FILTER_LZMA1, "preset": preset, "dict_size": dict_size, "lc": 3, "lp": 0, "pb": 2}]
+        properties = bytes([(2 * 5 + 0) * 9 + 3]) + UINT32.pack(dict_size)
+    elif codec == CodecId.LZMA2:
+        filters = [{"id": lzma.FILTER_LZMA2, "preset": preset, "dict_size": dict_size}]
+        properties = bytes([lzma2_dict_bits(dict_size)])
+    else:
+        raise NotImplementedError("Can only write LZMA and LZMA2 folders")
+    return filters, properties
+
+
+def compress_folder(data, filters, block_size=None):
+    if block_size is None or filters[0]["id"] != lzma.FILTER_LZMA2:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters)
+    # Every block starts with a dictionary reset, so readers can decode the blocks in parallel
+    blocks = [lzma.compress(data[start:start + block_size], format=lzma.FORMAT_RAW, filters=filters)[:-1]
+              for start in range(0, len(data), block_size)]
+    return b"".join(blocks) + b"\x00"
+
+
+def encode_coder(codec, properties):
+    return encode_varint(1) + bytes([0x20 | len(codec.value)]) + codec.value + \
+        encode_varint(len(properties)) + properties
+
+
+def encode_streams_info(pack_offset, pack_sizes, coder, unpack_sizes, checksums=None):
+    out = bytearray([PropertyId.kPackInfo]) + encode_varint(pack_offset) + encode_varint(len(pack_sizes))
+    out += bytes([PropertyId.kSize]) + b"".join(encode_varint(size) for size in pack_sizes)
+    out += bytes([PropertyId.kEnd])
+
+    out += bytes([PropertyId.kUnpackInfo, PropertyId.kFolder]) + encode_varint(len(unpack_sizes)) + b"\x00"
+    out += coder * len(unpack_sizes)
+    out += bytes([PropertyId.kCodersUnpackSize]) + b"".join(encode_varint(size) for size in unpack_sizes)
+    if checksums is not None:
+        out += bytes([PropertyId.kCRC, 1]) + b"".join(UINT32.pack(checksum) for checksum in checksums)
+    out += bytes([PropertyId.kEnd])
+    return out
+
+
+def encode_substreams_info(folders):
+    out = bytearray([PropertyId.kSubStreamsInfo, PropertyId.kNumUnpackStream])
+    out += b"".join(encode_varint(len(sizes)) for sizes, checksums in folders)
+    out += bytes([PropertyId.kSize])
+    out += b"".join(encode_varint(size) for sizes, checksums in folders for size in sizes[:-1])
+    out += bytes([PropertyId.kCRC, 1])
+    out += b"".join(UINT32.pack(checksum) for sizes, checksums in folders for checksum in checksums)
+    out += bytes([PropertyId.kEnd])
+    return out
+
+
+def encode_property(nid, data):
+    return bytes([nid]) + encode_varint(len(data)) + data
+
+
+def encode_files_info(names, empty_stream, empty_file):
+    out = bytearray([PropertyId.kFilesInfo]) + encode_varint(len(names))
+    if any(empty_stream):
+        out += encode_property(PropertyId.kEmptyStream, encode_bits(empty_stream))
+        out += encode_property(PropertyId.kEmptyFile, encode_bits(
+            [is_file for is_file, is_empty in zip(empty_file, empty_stream) if is_empty]))
+    name_table = b"".join(name.encode("utf-16-le", "surrogatepass") + b"\0\0" for name in names)
+    out += encode_property(PropertyId.kName, b"\x00" + name_table)
+    out += bytes([PropertyId.kEnd])
+    return out
+
+
+class SevenZipWriter(object):
+    def __init__(self, fd, codec=CodecId.LZMA2, preset=6, dict_size=1 << 23, folder_size=16 * 1024 * 1024,
+                 files_per_folder=None, block_size=None, jobs=None, close_fd=False):
+        self._fd = fd
+        self._close_fd = close_fd
+        self._filters, properties = coder_filters(CodecId(codec), preset, dict_size)
+        self._coder = encode_coder(CodecId(codec), properties)
+        self._folder_size = folder_size
+        self._files_per_folder = files_per_folder
+        self._block_size = block_size if CodecId(codec) == CodecId.LZMA2 else None
+        self._jobs = jobs
+        # A single solid folder gains nothing from the pool, and would have to be buffered whole to get there
+        solid = folder_size is None and files_per_folder is None
+        self._executor = ProcessPoolExecutor(jobs) if jobs is not None and jobs > 1 and not solid else None
+        self._pending = deque()
+        self._current = []
+        self._current_size = 0
+        self._current_sizes = []
+        self._current_crcs = []
+        self._compressor = None
+        self._block_left = 0
+        self._pack_size = 0
+        self._folders = []
+        self._pack_sizes = []
+        self._names = []
+        self._empty_stream = []
+        self._empty_file = []
+        self._start = fd.tell()
+        # The signature header points at the header, so it is written last
+        fd.write(bytes(SIGNATURE_HEADER_SIZE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def add(self, name, data):
+        self._names.append(name)
+        self._empty_stream.append(not data)
+        self._empty_file.append(True)
+        if not data:
+            return
+        if self._current_sizes and (
+                (self._folder_size is not None and self._current_size + len(data) > self._folder_size) or
+                (self._files_per_folder is not None and len(self._current_sizes) >= self._files_per_folder)):
+            self._flush_folder()
+        self._current_size += len(data)
+        self._current_sizes.append(len(data))
+        self._current_crcs.append(zlib.crc32(data))
+        if self._executor is None:
+            self._compress(data)
+        else:
+            self._current.append(bytes(data))
+
+    def add_directory(self, name):
+        self._names.append(name.rstrip("/"))
+        self._empty_stream.append(True)
+        self._empty_file.append(False)
+
+    def _compress(self, data):
+        # Without a pool, members are compressed as they are added and only compressed output is held
+        view = memoryview(data).cast("B")
+        while view:
+            if self._compressor is None:
+                self._compressor = lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=self._filters)
+                self._block_left = self._block_size
+            step = len(view) if self._block_size is None else min(len(view), self._block_left)
+            self._write(self._compressor.compress(view[:step]))
+            view = view[step:]
+            if self._block_size is not None:
+                self._block_left -= step
+                if not self._block_left:
+                    # Blocks are cut like compress_folder cuts them, dropping each end marker
+                    self._write(self._compressor.flush()[:-1])
+                    self._compressor = None
+
+    def _write(self, data):
+        self._fd.write(data)
+        self._pack_size += len(data)
+
+    def _flush_folder(self):
+        self._folders.append((self._current_sizes, self._current_crcs))
+        self._current_sizes, self._current_crcs = [], []
+        self._current_size = 0
+        if self._executor is None:
+            self._write(self._compressor.flush() if self._compressor is not None else b"\x00")
+            self._compressor = None
+            self._pack_sizes.append(self._pack_size)
+            self._pack_size = 0
+            return
+        data, self._current = b"".join(self._current), []
+        self._pending.append(self._executor.submit(compress_folder, data, self._filters, self._block_size))
+        # Folders are compressed out of order but written in order, bounding what is held in memory
+        while len(self._pending) > self._jobs * 2:
+            self._write_pack(self._pending.popleft().result())
+
+    def _write_pack(self, pack):
+        self._fd.write(pack)
+        self._pack_sizes.append(len(pack))
+
+    def _header(self):
+        out = bytearray([PropertyId.kHeader])
+        if self._folders:
+            out += bytes([PropertyId.kMainStreamsInfo])
+            out += encode_streams_info(0, self._pack_sizes, self._coder, [sum(sizes) for sizes, x in self._folders])
+            out += encode_substreams_info(self._folders)
+            out += bytes([PropertyId.kEnd])
+        out += encode_files_info(self._names, self._empty_stream, self._empty_file)
+        out += bytes([PropertyId.kEnd])
+        return bytes(out)
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            if self._current_sizes:
+                self._flush_folder()
+            while self._pending:
+                self._write_pack(self._pending.popleft().result())
+
+            header = self._header()
+            packed_header = compress_folder(header, self._filters)
+            payload_size = sum(self._pack_sizes)
+            self._fd.write(packed_header)
+
+            encoded = bytearray([PropertyId.kEncodedHeader])
+            encoded += encode_streams_info(payload_size, [len(packed_header)], self._coder, [len(header)],
+                                           [zlib.crc32(header)])
+            encoded += bytes([PropertyId.kEnd])
+            self._fd.write(encoded)
+
+            start_header = struct.pack("<QQI", payload_size + len(packed_header), len(encoded), zlib.crc32(encoded))
+            end = self._fd.tell()
+            self._fd.seek(self._start)
+            self._fd.write(SIGNATURE + UINT32.pack(zlib.crc32(start_header)) + start_header)
+            self._fd.seek(end)
+        finally:
+            self._abort()
+
+    def _abort(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._pending.clear()
+        if self._close_fd and self._fd is not None:
+            self._fd.close()
+        self._fd = None
+
+
+def create(arg, **kwargs):
+    if isinstance(arg, str):
+        return SevenZipWriter(builtins.open(arg, "wb"), close_fd=True, **kwargs)
+    if isinstance(arg, io.IOBase) and arg.seekable():
+        return SevenZipWriter(arg, **kwargs)
+    raise ValueError("Can only create a SevenZip archive from a filename or a seekable file object")
@@ -0,0 +1,24 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+from subsevenzip import aio
+
+
+# Async generators and comprehensions only parse on Python 3.6 and later, test_aio imports this module there
+async def extract(data):
+    async with await aio.open(data, crc_mode="verify-and-raise") as sz:
+        chunks = [(file.name, chunk) async for file, chunk in sz.iter_contents(chunk_size=4)]
+        async with sz.open_member(sz.files[1]) as member:
+            content = b"".join([chunk async for chunk in member])
+        return chunks, content, await sz.get_content(sz.files[2], 7)
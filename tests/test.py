@@ -13,8 +13,27 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 import subsevenzip
+from subsevenzip.codec import iter_lzma2_segments, register_decoder, DECODERS, ParallelLZMA2Reader
+from subsevenzip.codec import DecompressorReader, RawDeflateDecompressor
+from subsevenzip.enums import CodecId
+from subsevenzip.buffer import MemoryReadBuffer
+from subsevenzip.parser import parse_names
+from subsevenzip.cache import DecodedCache, SpillFile
+from subsevenzip.volume import VolumeStream, volume_paths
+from subsevenzip.writer import compress_folder
 import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import bz2
+import gzip
+import lzma
+import zlib
+from functools import partial
 import io
+import os
+import mmap
+import struct
 
 class TestSubSevenZip(unittest.TestCase):
     BASIC = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x03\x3b\x62\xd6\xd8\x6c\x00\x00\x00" \
@@ -29,6 +48,97 @@ class TestSubSevenZip(unittest.TestCase):
             b"\x09\x5c\x00\x07\x0b\x01\x00\x01\x23\x03\x01\x01\x05\x5d\x00\x10" \
             b"\x00\x00\x0c\x6e\x0a\x01\x8e\xe1\xbf\xaf\x00\x00"
 
+    MULTI_FOLDER = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\xb6\x19\xc0\xef\x7c\x00\x00\x00" \
+                   b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\xd4\xe8\xbc\x23" \
+                   b"\x00\x33\x1b\xc9\xcd\x8a\xa9\x61\x53\xf4\xf5\x3c\x99\xf5\xff\xff" \
+                   b"\x9d\xd2\x00\x00\x00\x33\x1b\xc9\xcd\x8a\xa9\x61\x53\xf8\x94\x00" \
+                   b"\x18\x76\xb2\xd4\x48\x8d\xe0\xb3\xff\xff\xdd\x9c\x00\x00\x00\x00" \
+                   b"\x81\x33\x07\xae\x31\x99\x96\x6f\xb7\x5c\xc3\xba\xd3\x27\x68\x5d" \
+                   b"\xf9\x1c\x3c\x59\x24\x88\xc8\x14\xc7\xe9\x1c\xe7\x8a\x1e\x4e\x47" \
+                   b"\x38\xd3\xb3\xd2\x5e\x6e\xa3\x7a\x64\x0c\x82\xed\x53\x76\x9a\x41" \
+                   b"\x19\x68\xe9\x41\xbe\x41\x41\xa9\x1c\xcc\x44\xb6\x96\xdd\x9d\x2d" \
+                   b"\x18\x5a\x89\xc5\xac\x5a\xbf\xff\xfd\xcc\xc0\x00\x17\x06\x2e\x01" \
+                   b"\x09\x4e\x00\x07\x0b\x01\x00\x01\x23\x03\x01\x01\x05\x5d\x00\x00" \
+                   b"\x01\x00\x0c\x5a\x0a\x01\x60\x5c\xda\xdb\x00\x00"
+
+    LZMA2 = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\x32\xd8\xf5\x20\x83\x00\x00\x00" \
+            b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x83\x5f\x7d\xd1" \
+            b"\xe0\x00\x5f\x00\x0f\x5d\x00\x36\x1e\x89\xdd\x7d\xfe\x8d\x04\xfd" \
+            b"\x85\x32\x85\x99\x00\x00\xe0\x00\x5f\x00\x12\x5d\x00\x36\x1e\x89" \
+            b"\xdd\x7d\xfe\x8d\x04\xfd\x80\x64\x6a\xc9\xc1\xe6\x9a\x00\x00\xe0" \
+            b"\x00\x3f\x00\x0f\x5d\x00\x36\x1e\x89\xdd\x7d\xfe\x8d\x07\xab\xe2" \
+            b"\x8b\xd1\x99\x00\x00\x00\x00\x00\x81\x33\x07\xae\x0f\xd2\x40\x67" \
+            b"\x7d\x40\xc0\x90\xd2\xff\x74\xa1\xcd\x8a\xde\x03\x54\xe3\x2e\xe2" \
+            b"\xc3\xd2\xe6\x54\x55\x78\xd2\xc9\xd3\x61\xa0\x4c\xbd\x00\x40\x13" \
+            b"\x58\xe2\x14\xb8\x39\xf7\x86\x73\x2e\x03\xdd\xf3\x7c\xff\xff\xf7" \
+            b"\xd7\xd8\x00\x17\x06\x46\x01\x09\x3d\x00\x07\x0b\x01\x00\x01\x23" \
+            b"\x03\x01\x01\x05\x5d\x00\x00\x01\x00\x0c\x36\x0a\x01\x14\x69\x0c" \
+            b"\x01\x00\x00"
+
+    DELTA = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\xcf\x99\xf5\x72\x6a\x00\x00\x00" \
+            b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x5d\xba\xf5\x52" \
+            b"\x00\x00\x00\x9f\xbd\x6c\xe1\xd0\x00\x02\x5a\xed\x64\x7f\x5c\x50" \
+            b"\x25\x32\xac\x6b\xff\xff\x3a\xb8\x00\x00\x00\x00\x81\x33\x07\xae" \
+            b"\x0f\xcf\xa4\x2e\xb8\x0f\xd4\x6a\x5e\x37\xf2\x23\xf7\x59\x54\x43" \
+            b"\x5e\xcb\x6d\x7d\xa2\xf9\x6a\xe1\x48\x9f\xf8\x99\x16\xa9\x58\xd5" \
+            b"\x3d\x49\xe6\x6e\x3a\xc2\x49\xcc\x96\x32\x49\x23\x2f\xdd\x52\x84" \
+            b"\xf9\x58\x52\x2d\x15\x41\x4e\x13\x1c\x2a\x8d\x73\x50\xa9\xf6\xf0" \
+            b"\x94\x5a\x14\x17\xff\xff\x7b\x7c\x00\x00\x17\x06\x1a\x01\x09\x50" \
+            b"\x00\x07\x0b\x01\x00\x01\x23\x03\x01\x01\x05\x5d\x00\x00\x01\x00" \
+            b"\x0c\x59\x0a\x01\x8a\xae\x56\xe3\x00\x00"
+
+    BCJ_X86 = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\x08\x42\x99\x51\x5f\x00\x00\x00" \
+              b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x93\x52\x0d\x81" \
+              b"\xe0\x00\x27\x00\x16\x5d\x00\x2a\xa2\x58\xae\x80\xbf\xd3\x5f\x2e" \
+              b"\xaa\xa4\x7b\xc2\x42\xd0\x0c\x67\x56\x9a\x98\x00\x00\x00\x00\x00" \
+              b"\x81\x33\x07\xae\x0f\xcf\xeb\x30\x14\x0f\xd4\x6a\x5e\x7d\xe5\xc6" \
+              b"\xc6\xb8\x13\x0a\x48\x55\x7d\xd5\x9f\x9a\x4d\xfc\xad\x1f\xd9\xba" \
+              b"\x33\x5a\x56\x38\xaf\x83\xb5\xda\x39\x66\xcf\xb0\x96\xbe\x4c\x8d" \
+              b"\x15\x3e\xb3\x39\xae\x43\x07\xd1\x9f\xff\xff\x54\xe4\x00\x00\x17" \
+              b"\x06\x1e\x01\x09\x41\x00\x07\x0b\x01\x00\x01\x23\x03\x01\x01\x05" \
+              b"\x5d\x00\x00\x01\x00\x0c\x3f\x0a\x01\x57\x46\xdc\xef\x00\x00"
+
+    COPY = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\x80\x72\x21\x45\x96\x00\x00\x00" \
+           b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x5b\x9f\x3c\xf9" \
+           b"\x73\x74\x6f\x72\x65\x64\x0a\x73\x74\x6f\x72\x65\x64\x0a\x73\x74" \
+           b"\x6f\x72\x65\x64\x0a\x63\x6f\x64\x65\x63\x20\x72\x65\x67\x69\x73" \
+           b"\x74\x72\x79\x0a\x63\x6f\x64\x65\x63\x20\x72\x65\x67\x69\x73\x74" \
+           b"\x72\x79\x0a\x63\x6f\x64\x65\x63\x20\x72\x65\x67\x69\x73\x74\x72" \
+           b"\x79\x0a\x63\x6f\x64\x65\x63\x20\x72\x65\x67\x69\x73\x74\x72\x79" \
+           b"\x0a\x00\x00\x81\x33\x07\xae\x0f\xd2\xce\x57\x3d\x40\xc0\x90\xf1" \
+           b"\xad\xc1\x40\x86\x5f\xde\xa9\x7c\xf5\xf3\x8d\x9c\x7a\xc5\x07\x1a" \
+           b"\xd4\x61\x96\x36\xbd\x24\x89\x2f\x45\x10\xa2\x49\x24\xe6\xa6\xa3" \
+           b"\xa4\xfa\x5d\x9c\xea\x25\x24\xd7\x1f\xba\xae\x0b\xbf\x4d\x19\x23" \
+           b"\xff\xff\xf1\xb5\x8c\x00\x17\x06\x51\x01\x09\x45\x00\x07\x0b\x01" \
+           b"\x00\x01\x23\x03\x01\x01\x05\x5d\x00\x00\x01\x00\x0c\x42\x0a\x01" \
+           b"\x54\x69\x72\x69\x00\x00"
+
+    DEFLATE = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\x3f\xd3\xee\x3b\x61\x00\x00\x00" \
+              b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x8b\xcf\x77\xa5" \
+              b"\x2b\x2e\xc9\x2f\x4a\x4d\xe1\x2a\x46\xa1\x92\xf3\x53\x52\x93\x15" \
+              b"\x8a\x52\xd3\x33\x8b\x4b\x8a\x2a\x49\xe3\x02\x00\x00\x00\x81\x33" \
+              b"\x07\xae\x0f\xcf\xc7\xaf\x68\x0f\xeb\xea\x89\x7f\xe4\xcb\x6d\x1d" \
+              b"\xee\x08\x31\x69\x45\x56\x44\x20\x3b\x9b\x44\x0e\xfc\xcf\x71\x1b" \
+              b"\x90\x26\x27\xbc\xca\xf0\x62\xa1\xab\x4f\x08\xcc\xe9\xf8\xf0\x0e" \
+              b"\xe3\xec\x7c\x7e\x9f\xf6\xd9\x2c\x9a\xad\xa3\xff\xff\xb6\xa2\x00" \
+              b"\x00\x17\x06\x1c\x01\x09\x45\x00\x07\x0b\x01\x00\x01\x23\x03\x01" \
+              b"\x01\x05\x5d\x00\x00\x01\x00\x0c\x44\x0a\x01\xce\x2d\x44\x6c\x00" \
+              b"\x00"
+
+    BZIP2 = b"\x37\x7a\xbc\xaf\x27\x1c\x00\x04\x0d\xf3\x0f\x63\x8d\x00\x00\x00" \
+            b"\x00\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x98\x95\x4d\xd6" \
+            b"\x42\x5a\x68\x39\x31\x41\x59\x26\x53\x59\xd8\x30\xc3\xb6\x00\x00" \
+            b"\x20\xd1\x80\x00\x10\x40\x00\x0e\xa0\x9c\x20\x20\x00\x50\x81\xa0" \
+            b"\x68\x05\x49\x4c\x26\x4f\x53\x17\x29\x59\x34\x64\xa9\xc3\x47\x64" \
+            b"\xc1\xc3\x65\xcd\xce\x9e\x1c\x9f\x17\x27\x4f\xc5\xdc\x91\x4e\x14" \
+            b"\x24\x36\x0c\x30\xed\x80\x00\x00\x81\x33\x07\xae\x0f\xd2\x40\x67" \
+            b"\x7d\x40\xc0\x90\xce\xe5\xcb\x76\xf6\x48\xbc\xae\xba\x0b\x38\x2d" \
+            b"\x98\x60\xf7\x49\xb9\xfb\x33\xc5\x81\x5b\x7e\x5a\x33\x40\xac\x05" \
+            b"\x7b\x8d\xfc\x83\x90\xe1\x97\x89\x50\x57\x8e\x18\xa8\x04\xea\x9a" \
+            b"\xb0\x15\x83\xc6\x9d\xf3\xa7\xff\xff\xe3\xbf\x38\x00\x17\x06\x46" \
+            b"\x01\x09\x47\x00\x07\x0b\x01\x00\x01\x23\x03\x01\x01\x05\x5d\x00" \
+            b"\x00\x01\x00\x0c\x44\x0a\x01\x2b\x88\x89\xfd\x00\x00"
+
     def test_basic(self):
         stream = io.BytesIO(TestSubSevenZip.BASIC)
         sz = subsevenzip.open(stream)
@@ -37,5 +147,483 @@ class TestSubSevenZip(unittest.TestCase):
         self.assertEqual("test_b", sz.files[1].name)
         self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
 
+    def test_backward_seek(self):
+        sz = subsevenzip.open(TestSubSevenZip.BASIC)
+        self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
+        self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+
+    def test_iter_contents(self):
+        sz = subsevenzip.open(TestSubSevenZip.BASIC)
+        contents = [(file.name, content) for file, content in sz.iter_contents()]
+        self.assertEqual([("test_a", b"test_a\n"), ("test_b", b"test_b\n")], contents)
+
+    def test_get_contents(self):
+        sz = subsevenzip.open(TestSubSevenZip.BASIC)
+        contents = sz.get_contents([sz.files[1], sz.files[0], sz.files[1]])
+        self.assertEqual([b"test_b\n", b"test_a\n", b"test_b\n"], contents)
+        self.assertEqual(14, contents.bytes_decoded)
+        self.assertEqual(0, contents.bytes_discarded)
+
+        contents = sz.get_contents([sz.files[1]])
+        self.assertEqual([b"test_b\n"], contents)
+        self.assertEqual(14, contents.bytes_decoded)
+        self.assertEqual(7, contents.bytes_discarded)
+
+    def test_cache(self):
+        sz = subsevenzip.open(TestSubSevenZip.BASIC, cache_size=1024)
+        self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
+        self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+        self.assertEqual((1, 1, 0), (sz.cache.hits, sz.cache.misses, sz.cache.evictions))
+
+        sz.cache = DecodedCache(8, window_size=4)
+        self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
+        self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+        self.assertEqual(8, sz.cache.size)
+        self.assertEqual(3, sz.cache.evictions)
+
+        sz = subsevenzip.open(TestSubSevenZip.BASIC, cache_size=8)
+        self.assertEqual(8, sz.cache.window_size)
+        self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+        self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+        self.assertEqual((1, 1), (sz.cache.hits, sz.cache.misses))
+        self.assertRaises(ValueError, subsevenzip.open, TestSubSevenZip.BASIC, cache_size=8, cache_window=16)
+
+    def test_spill(self):
+        with subsevenzip.open(TestSubSevenZip.BASIC, spill_limit=1024) as sz:
+            self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
+            self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+            self.assertTrue(sz._folders[0].spill.is_filled())
+        self.assertFalse(sz._folders[0].spill.is_filled())
+
+        sz = subsevenzip.open(TestSubSevenZip.BASIC, spill_limit=8)
+        self.assertIsNone(sz._folders[0].spill)
+
+        # A failed fill leaves nothing behind, so the next read retries
+        spill = SpillFile(1024)
+        self.assertRaises(IOError, spill.fill, io.BytesIO(b"short"), 10)
+        self.assertFalse(spill.is_filled())
+        spill.fill(io.BytesIO(b"0123456789"), 10)
+        self.assertEqual(b"2345", spill.get(2, 4))
+        spill.close()
+
+    def test_multi_folder(self):
+        sz = subsevenzip.open(TestSubSevenZip.MULTI_FOLDER)
+        self.assertEqual([0, 1, 1, 0], [file._folder for file in sz.files])
+        self.assertFalse(sz.files[3].has_stream)
+        self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+        self.assertEqual(b"folder_0\n", sz.get_content(sz.files[0]))
+        expected = [b"folder_0\n", b"folder_1_b\n", b"folder_1_c\n", b""]
+        self.assertEqual(expected, [content for file, content in sz.iter_contents()])
+        contents = sz.get_contents(reversed(sz.files), jobs=2)
+        self.assertEqual(expected[::-1], contents)
+        self.assertEqual(31, contents.bytes_decoded)
+
+    def test_lzma2(self):
+        segments = list(iter_lzma2_segments(io.BytesIO(TestSubSevenZip.LZMA2[32:])))
+        self.assertEqual(3, len(segments))
+
+        expected = [b"lzma2_a\n" * 16, b"lzma2_b\n" * 16]
+        for jobs in (None, 2):
+            with subsevenzip.open(TestSubSevenZip.LZMA2, jobs=jobs) as sz:
+                self.assertEqual(expected[1], sz.get_content(sz.files[1]))
+                self.assertEqual(expected[0], sz.get_content(sz.files[0]))
+                self.assertEqual(expected, [content for file, content in sz.iter_contents()])
+
+        # Segments decoding to more than the limit are streamed, bounded ones are decoded ahead
+        data = b"".join(("segment %d\n" % x).encode() for x in range(4096))
+        filters = [{"id": lzma.FILTER_LZMA2, "dict_size": 1 << 16}]
+        with ThreadPoolExecutor(2) as executor:
+            for block_size, serial in ((None, True), (4096, False)):
+                packed = io.BytesIO(compress_folder(data, filters, block_size))
+                reader = ParallelLZMA2Reader(packed, filters, executor, 2, segment_limit=8192)
+                self.assertEqual(data[:3], reader.read(3))
+                self.assertEqual(serial, reader._serial is not None)
+                self.assertLessEqual(reader._queued, 2 * 8192)
+                reader.seek(1000)
+                self.assertEqual(data[1000:], reader.read())
+                reader.close()
+
+            # Only the oversized segment is streamed, the following ones go back to the executor
+            packed = io.BytesIO(compress_folder(data[:4096], filters)[:-1] +
+                                compress_folder(data[4096:40000], filters)[:-1] +
+                                compress_folder(data[40000:], filters, 4096))
+            reader = ParallelLZMA2Reader(packed, filters, executor, 2, segment_limit=8192)
+            self.assertEqual(data[:5000], reader.read(5000))
+            self.assertIsNotNone(reader._serial)
+            self.assertEqual(data[5000:40001], reader.read(35001))
+            self.assertIsNone(reader._serial)
+            self.assertEqual(data[40001:], reader.read())
+            reader.close()
+
+        with tempfile.TemporaryFile() as fd:
+            with subsevenzip.create(fd, block_size=1 << 16) as writer:
+                writer.add("data", data * 4)
+            fd.seek(0)
+            with subsevenzip.open(fd, jobs=2, segment_limit=1 << 16) as sz, sz.open_member(sz.files[0]) as member:
+                self.assertEqual(data[:3], member.read(3))
+                self.assertIsNone(member._stream._serial)
+                self.assertEqual(data * 4, data[:3] + member.read())
+
+    def test_memory_read_buffer(self):
+        buf = MemoryReadBuffer(b"\x7f\x81\x02\xc0\x34\x12\x01\x00\x74\x00\x00\x00\xff")
+        self.assertEqual(0x7f, buf.get_varint())
+        self.assertEqual(0x102, buf.get_varint())
+        self.assertEqual(0x1234, buf.get_varint())
+        self.assertEqual(1, buf.get_uint16())
+        self.assertEqual(b"t\x00\x00\x00", buf.get_bytes(4))
+        buf.set_limit(0)
+        self.assertRaises(IOError, buf.get_uint8)
+        buf.unset_limit()
+        self.assertEqual(0xff, buf.get_uint8())
+        self.assertRaises(IOError, buf.get_uint32)
+
+    def test_open_path(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "basic.7z")
+            with open(path, "wb") as fd:
+                fd.write(TestSubSevenZip.BASIC)
+            with subsevenzip.open(path, cache_size=1024) as sz:
+                mapping = sz._fd
+                self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
+                self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+                with sz.open_member(sz.files[1]) as member:
+                    self.assertEqual(b"test", member.read(4))
+            self.assertTrue(mapping.closed)
+
+            with open(path, "wb") as fd:
+                pass
+            self.assertRaises(subsevenzip.BadSevenZipArchive, subsevenzip.open, path)
+
+    def test_open_corrupt(self):
+        # Handles opened for an archive whose headers fail to parse are closed again
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ("corrupt.7z", "corrupt.7z.001", "corrupt.7z.002")]
+            for path, data in zip(paths, (TestSubSevenZip.BASIC[:-8], TestSubSevenZip.BASIC[:40],
+                                          TestSubSevenZip.BASIC[40:-8])):
+                with open(path, "wb") as fd:
+                    fd.write(data)
+            mappings = []
+
+            def track(*args, mapper=mmap.mmap, **kwargs):
+                mappings.append(mapper(*args, **kwargs))
+                return mappings[-1]
+
+            with mock.patch("mmap.mmap", side_effect=track):
+                self.assertRaises(IOError, subsevenzip.open, paths[0])
+            self.assertTrue(mappings[0].closed)
+            with mock.patch.object(VolumeStream, "close", autospec=True) as close:
+                # File object reads come up short rather than hitting the end of a mapping
+                self.assertRaises(struct.error, subsevenzip.open, paths[1])
+            self.assertEqual(1, close.call_count)
+
+    def test_bit_vector(self):
+        bits = MemoryReadBuffer(b"\xa0\x40").get_bits(10)
+        self.assertEqual([True, False, True, False, False, False, False, False, False, True], list(bits))
+        self.assertEqual([0, 2, 9], list(bits.iter_set()))
+        self.assertEqual(3, bits.count())
+        self.assertRaises(IndexError, bits.__getitem__, 10)
+
+        ones = MemoryReadBuffer(b"\x01").get_all_or_bits(10)
+        self.assertEqual(list(range(10)), list(ones.iter_set()))
+        self.assertEqual(b"\xff\xc0", ones.tobytes())
+
+        # Ranks cross the 64 byte blocks of the rank table
+        wide = MemoryReadBuffer(b"\x81" * 130).get_bits(1040)
+        self.assertEqual([0, 1, 128, 129, 260], [wide.rank(index) for index in (0, 1, 512, 519, 1040)])
+
+    def test_parse_names(self):
+        table = "a\0bc\0".encode("utf-16-le")
+        self.assertEqual(["a", "bc"], parse_names(MemoryReadBuffer(table), len(table), 2))
+        self.assertEqual(["a"], parse_names(MemoryReadBuffer(table), len(table), 1))
+        self.assertRaises(IOError, parse_names, MemoryReadBuffer(table), len(table) - 1, 2)
+        self.assertRaises(IOError, parse_names, MemoryReadBuffer(table), len(table), 3)
+
+    def test_file_table(self):
+        sz = subsevenzip.open(TestSubSevenZip.MULTI_FOLDER)
+        self.assertEqual(4, len(sz.files))
+        self.assertEqual("c", sz.files.get("c").name)
+        self.assertEqual(2, sz.files.index_of("c"))
+        self.assertIsNone(sz.files.get("missing"))
+        self.assertEqual(["c", "d"], [file.name for file in sz.files[2:]])
+        self.assertEqual(["b"], [file.name for file in sz.files.find_prefix("b")])
+        self.assertEqual(["a", "c"], [file.name for file in sz.files.glob("[ac]")])
+        self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files.get("c")))
+
+    def test_header_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "multi.7z")
+            with open(path, "wb") as fd:
+                fd.write(TestSubSevenZip.MULTI_FOLDER)
+            for x in range(2):
+                with subsevenzip.open(path, index_dir=directory) as sz:
+                    self.assertEqual(["a", "b", "c", "d"], [file.name for file in sz.files])
+                    self.assertEqual([True, True, True, False], [file.has_stream for file in sz.files])
+                    self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+            self.assertEqual(1, len([name for name in os.listdir(directory) if name.endswith(".7zi")]))
+
+            with mock.patch("subsevenzip.archive.parse_headers") as parse_headers:
+                with subsevenzip.open(path, index_dir=directory) as sz:
+                    self.assertEqual(b"folder_0\n", sz.get_content(sz.files[0]))
+                self.assertFalse(parse_headers.called)
+
+    def test_open_member(self):
+        sz = subsevenzip.open(TestSubSevenZip.MULTI_FOLDER)
+        with sz.open_member(sz.files[2]) as member:
+            self.assertEqual(b"folder", member.read(6))
+            buffer = bytearray(16)
+            self.assertEqual(5, member.readinto(buffer))
+            self.assertEqual(b"_1_c\n", buffer[:5])
+            self.assertEqual(b"", member.read(1))
+        with sz.open_member(sz.files[1]) as member:
+            self.assertEqual([b"folder_1_b\n"], list(member))
+        with sz.open_member(sz.files[3]) as member:
+            self.assertEqual(b"", member.read())
+        self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+
+        out = io.BytesIO()
+        with subsevenzip.create(out) as writer:
+            writer.add_directory("d")
+            writer.add("e", b"")
+            writer.add("f", b"line\n" * 500000)
+        sz = subsevenzip.open(out.getvalue(), crc_mode="verify-and-raise")
+        for file in sz.files[:2]:
+            with sz.open_member(file) as member:
+                self.assertEqual(b"", member.read())
+        with sz.open_member(sz.files[2]) as member:
+            self.assertEqual([1 << 20, 1 << 20, 500000 * 5 - (2 << 20)], [len(chunk) for chunk in member])
+        with sz.open_member(sz.files[2]) as member:
+            buffer = bytearray(500000 * 5 + 1)
+            self.assertEqual(500000 * 5, member.readinto(buffer))
+            self.assertEqual(b"line\n" * 500000, buffer[:-1])
+
+    def test_crc(self):
+        sz = subsevenzip.open(TestSubSevenZip.MULTI_FOLDER, crc_mode="verify-and-raise")
+        self.assertEqual([0xb9a9de3a, None], [file.crc for file in sz.files[2:]])
+        self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+
+        sz.files.checksums[2] ^= 1
+        self.assertRaises(subsevenzip.BadSevenZipArchive, sz.get_content, sz.files[2])
+        with sz.open_member(sz.files[2]) as member:
+            self.assertEqual(b"folder_1", member.read(8))
+            self.assertRaises(subsevenzip.BadSevenZipArchive, member.read)
+
+        sz.crc_mode = subsevenzip.CrcMode.VERIFY
+        self.assertEqual(4, len(sz.get_contents(sz.files)))
+        self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+        self.assertEqual(2, len(sz.crc_errors))
+
+    def test_concurrent_readers(self):
+        expected = [b"folder_0\n", b"folder_1_b\n", b"folder_1_c\n", b""]
+        with tempfile.TemporaryFile() as fd:
+            fd.write(TestSubSevenZip.MULTI_FOLDER)
+            fd.seek(0)
+            cases = [(arg, {"cache_size": 16}) for arg in (TestSubSevenZip.MULTI_FOLDER, fd,
+                                                           io.BytesIO(TestSubSevenZip.MULTI_FOLDER))]
+            # Every thread races to fill the spill on its first read
+            cases += [(TestSubSevenZip.MULTI_FOLDER, {"spill_limit": 1024})] * 5
+            for arg, options in cases:
+                with subsevenzip.open(arg, **options) as sz:
+                    def read_member(index):
+                        with sz.open_member(sz.files[index]) as member:
+                            return member.read()
+
+                    order = [index % 4 for index in range(200)][::-1]
+                    with ThreadPoolExecutor(8) as executor:
+                        contents = list(executor.map(lambda index: sz.get_content(sz.files[index]), order))
+                        members = list(executor.map(read_member, order))
+                self.assertEqual([expected[index] for index in order], contents)
+                self.assertEqual([expected[index] for index in order], members)
+
+    def test_compressed_file_object(self):
+        # GzipFile has the fileno of the compressed file, reads must go through the wrapper
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "basic.7z.gz")
+            with gzip.open(path, "wb") as fd:
+                fd.write(TestSubSevenZip.BASIC)
+            with gzip.open(path) as fd, subsevenzip.open(fd) as sz:
+                self.assertEqual(b"test_a\n", sz.get_content(sz.files[0]))
+                self.assertEqual(b"test_b\n", sz.get_content(sz.files[1]))
+
+    def test_failed_decoder(self):
+        sz = subsevenzip.open(TestSubSevenZip.MULTI_FOLDER)
+        folder = sz._folders[1]
+        stream = mock.Mock(**{"tell.return_value": 0, "read.side_effect": IOError})
+        with mock.patch.object(folder, "_factory", return_value=stream):
+            self.assertRaises(IOError, sz.get_content, sz.files[1])
+            self.assertRaises(IOError, sz.get_contents, sz.files[1:3])
+            with sz.open_member(sz.files[2]) as member:
+                self.assertRaises(IOError, member.read)
+        self.assertEqual(3, stream.close.call_count)
+        self.assertEqual([], folder._idle)
+        self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+
+    def test_range_read(self):
+        sz = subsevenzip.open(TestSubSevenZip.LZMA2)
+        self.assertEqual(b"lzma2_a", sz.get_content(sz.files[0], 0, 7))
+        self.assertEqual(b"\nlzma2_a", sz.get_content(sz.files[0], 7, 8))
+        self.assertEqual(b"lzma2_b\n", sz.get_content(sz.files[1], 120))
+        self.assertEqual(b"", sz.get_content(sz.files[1], 200, 10))
+        self.assertEqual(1, len(sz._folders[0]._idle))
+        self.assertEqual(256, sz._folders[0]._idle[0].tell())
+        self.assertRaises(ValueError, sz.get_content, sz.files[0], -1)
+
+    def test_extractall(self):
+        sz = subsevenzip.open(TestSubSevenZip.MULTI_FOLDER)
+        self.assertEqual([False, False, False, True], [file.is_dir for file in sz.files])
+        with tempfile.TemporaryDirectory() as directory:
+            sz.extractall(directory, jobs=2, chunk_size=4)
+            self.assertEqual(["a", "b", "c", "d"], sorted(os.listdir(directory)))
+            self.assertTrue(os.path.isdir(os.path.join(directory, "d")))
+            with open(os.path.join(directory, "b"), "rb") as fd:
+                self.assertEqual(b"folder_1_b\n", fd.read())
+
+            sz.files.names[0] = "../a"
+            self.assertRaises(subsevenzip.BadSevenZipArchive, sz.extractall, directory)
+
+    def test_filter_chain(self):
+        with subsevenzip.open(TestSubSevenZip.DELTA, crc_mode="verify-and-raise") as sz:
+            self.assertEqual(bytes(range(0, 64, 2)), sz.get_content(sz.files[0]))
+            self.assertEqual(b"delta\n" * 4, sz.get_content(sz.files[1]))
+
+        # The BCJ coder is listed after LZMA2, so the chain has to be followed through the bind pairs
+        for jobs in (None, 2):
+            with subsevenzip.open(TestSubSevenZip.BCJ_X86, jobs=jobs, crc_mode="verify-and-raise") as sz:
+                self.assertEqual(b"\x55\x89\xe5\xe8\x10\x00\x00\x00\x5d\xc3" * 4, sz.get_content(sz.files[0]))
+
+    def test_codecs(self):
+        for data in (TestSubSevenZip.COPY, TestSubSevenZip.DEFLATE, TestSubSevenZip.BZIP2):
+            with subsevenzip.open(data, crc_mode="verify-and-raise") as sz:
+                self.assertEqual(b"codec registry\n" * 4, sz.get_content(sz.files[1]))
+                self.assertEqual(b"stored\n" * 3, sz.get_content(sz.files[0]))
+                self.assertEqual(b"registry", sz.get_content(sz.files[1], 21, 8))
+                self.assertEqual([b"stored\n" * 3, b"codec registry\n" * 4], list(sz.get_contents(sz.files)))
+
+        # Stored members are read as views of the archive, but handed out as bytes however it was opened
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "copy.7z")
+            with open(path, "wb") as fd:
+                fd.write(TestSubSevenZip.COPY)
+            for arg, options in ((TestSubSevenZip.COPY, {}), (path, {}), (path, {"cache_size": 1024})):
+                with subsevenzip.open(arg, **options) as sz:
+                    self.assertIs(bytes, type(sz.get_content(sz.files[0])))
+                    self.assertIs(bytes, type(sz.get_contents(sz.files)[1]))
+                    self.assertEqual([bytes, bytes], [type(content) for file, content in sz.iter_contents()])
+                    with sz.open_member(sz.files[0]) as member:
+                        self.assertIs(bytes, type(member.read(3)))
+                        buffer = bytearray(4)
+                        self.assertEqual(4, member.readinto(buffer))
+                        self.assertEqual(b"red\n", buffer)
+
+        with mock.patch.dict(DECODERS):
+            register_decoder(CodecId.COPY, lambda stream, *args: io.BytesIO(bytes(stream.read()).upper()))
+            with subsevenzip.open(TestSubSevenZip.COPY) as sz:
+                self.assertEqual(b"STORED\n" * 3, sz.get_content(sz.files[0]))
+
+    def test_deflate_small_reads(self):
+        # zlib keeps output buffered after consuming the last input when a read is capped
+        data = b"".join(("deflate %d\n" % (x % 7)).encode() for x in range(12))
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        stream = io.BytesIO(compressor.compress(data) + compressor.flush())
+        reader = DecompressorReader(stream, RawDeflateDecompressor())
+        self.assertEqual(data, b"".join(iter(partial(reader.read, 10), b"")))
+
+        with subsevenzip.open(TestSubSevenZip.DEFLATE) as sz:
+            with sz.open_member(sz.files[1]) as member:
+                self.assertEqual(b"codec registry\n" * 4, b"".join(iter(partial(member.read, 3), b"")))
+
+        # Python 3.4 bz2 decompressors can't cap their output, the surplus is buffered instead
+        class LegacyDecompressor(object):
+            def __init__(self):
+                self._decompressor = decompressor_type()
+
+            eof = property(lambda self: self._decompressor.eof)
+
+            def decompress(self, data):
+                return self._decompressor.decompress(data)
+
+        decompressor_type = bz2.BZ2Decompressor
+        with mock.patch("bz2.BZ2Decompressor", LegacyDecompressor):
+            with subsevenzip.open(TestSubSevenZip.BZIP2, crc_mode="verify-and-raise") as sz:
+                with sz.open_member(sz.files[1]) as member:
+                    self.assertEqual(b"codec registry\n" * 4, b"".join(iter(partial(member.read, 3), b"")))
+                self.assertEqual([b"stored\n" * 3, b"codec registry\n" * 4], list(sz.get_contents(sz.files)))
+
+    def test_stats(self):
+        events = []
+        stats = subsevenzip.Stats(lambda *event: events.append(event))
+        with subsevenzip.open(io.BytesIO(TestSubSevenZip.MULTI_FOLDER), stats=stats) as sz:
+            self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files[2]))
+            self.assertEqual(b"folder_1_b\n", sz.get_content(sz.files[1]))
+
+        counters = stats.snapshot()["counters"]
+        # Going back to b restarts the folder, and c needed b to be decoded and skipped first
+        self.assertEqual(1, counters["decoder_restarts"])
+        self.assertEqual(2, counters["decoder_starts"])
+        self.assertEqual(11, counters["bytes_skipped"])
+        self.assertEqual(33, counters["bytes_decoded"])
+        self.assertEqual(22, counters["bytes_returned"])
+        self.assertLess(0, counters["io_reads"])
+        self.assertEqual({"signature", "header_decode", "header_parse", "member_decode"}, set(stats.timings))
+        self.assertIn(("count", "bytes_returned", 11), events)
+
+    def test_writer(self):
+        members = [("a", b"writer_a\n" * 64), ("sub/ä", b"writer_b\n"), ("sub/empty", b""), ("c", b"writer_c\n" * 8)]
+        # Block size 9 ends the folder exactly on a block boundary
+        for options in ({}, {"codec": CodecId.LZMA, "files_per_folder": 1, "jobs": 2}, {"block_size": 128},
+                        {"block_size": 9}, {"folder_size": None, "jobs": 2}):
+            out = io.BytesIO()
+            with subsevenzip.create(out, **options) as writer:
+                writer.add_directory("sub/")
+                for name, content in members:
+                    writer.add(name, content)
+
+            with subsevenzip.open(out.getvalue(), jobs=2, crc_mode="verify-and-raise") as sz:
+                self.assertEqual(["sub", "a", "sub/ä", "sub/empty", "c"], [file.name for file in sz.files])
+                self.assertEqual([True, False, False, False, False], [file.is_dir for file in sz.files])
+                self.assertEqual([b""] + [content for name, content in members], list(sz.get_contents(sz.files)))
+                folders = set(file._folder for file in sz.files if file.has_stream)
+                self.assertEqual(3 if "files_per_folder" in options else 1, len(folders))
+
+    def test_lazy_header(self):
+        def describe(file):
+            return file.name, file.size, file._offset, file._folder, file.crc, file.is_dir, file.has_stream
+
+        for data in (TestSubSevenZip.MULTI_FOLDER, TestSubSevenZip.LZMA2, TestSubSevenZip.BASIC):
+            with subsevenzip.open(data) as eager, subsevenzip.open(data, lazy=True) as lazy:
+                expected = [describe(file) for file in eager.files]
+                backward = [describe(lazy.files[index]) for index in range(len(lazy.files) - 1, -1, -1)]
+                self.assertEqual(expected[::-1], backward)
+                self.assertIsNone(lazy.files._columns)
+                self.assertEqual(list(eager.files.sizes), list(lazy.files.sizes))
+                self.assertEqual(expected, [describe(file) for file in lazy.files])
+
+        with subsevenzip.open(TestSubSevenZip.MULTI_FOLDER, lazy=True, crc_mode="verify-and-raise") as sz:
+            self.assertEqual(b"folder_1_c\n", sz.get_content(sz.files.get("c")))
+            self.assertIsNone(sz.files._columns)
+
+    def test_volumes(self):
+        data = TestSubSevenZip.MULTI_FOLDER
+        with tempfile.TemporaryDirectory() as directory:
+            # Boundaries fall inside the first pack stream and inside the encoded header
+            paths = []
+            bounds = [0, 40, 41, len(data) - 20, len(data)]
+            for index, (start, end) in enumerate(zip(bounds, bounds[1:])):
+                paths.append(os.path.join(directory, "multi.7z.%03d" % (index + 1)))
+                with open(paths[-1], "wb") as fd:
+                    fd.write(data[start:end])
+
+            self.assertEqual(paths, volume_paths(paths[0]))
+
+            stream = VolumeStream(paths, max_open=1)
+            self.assertEqual(data[30:60], stream.pread(30, 30))
+            stream.seek(-25, io.SEEK_END)
+            self.assertEqual(data[-25:], stream.read())
+            stream.close()
+
+            for arg in (paths, paths[0]):
+                with subsevenzip.open(arg, crc_mode="verify-and-raise") as sz:
+                    self.assertEqual([b"folder_0\n", b"folder_1_b\n", b"folder_1_c\n", b""],
+                                     [content for file, content in sz.iter_contents()])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,45 @@
+# Copyright (c) 2015, Daniel Svensson <dsvensson@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+import io
+import sys
+import asyncio
+import unittest
+
+import subsevenzip
+
+if sys.version_info >= (3, 6):
+    from aio_cases import extract
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio support needs Python 3.6")
+class TestAio(unittest.TestCase):
+    def test_aio(self):
+        out = io.BytesIO()
+        with subsevenzip.create(out) as writer:
+            writer.add("a", b"folder_0\n")
+            writer.add("b", b"folder_1_b\n")
+            writer.add("c", b"folder_1_c\n")
+            writer.add_directory("d")
+
+        loop = asyncio.new_event_loop()
+        try:
+            chunks, content, tail = loop.run_until_complete(extract(out.getvalue()))
+        finally:
+            loop.close()
+        self.assertEqual(("a", b"fold"), chunks[0])
+        self.assertEqual(("d", b""), chunks[-1])
+        self.assertEqual(b"folder_1_c\n", b"".join(chunk for name, chunk in chunks if name == "c"))
+        self.assertEqual(b"folder_1_b\n", content)
+        self.assertEqual(b"1_c\n", tail)